@@ -1,9 +1,22 @@
+"""
+Atmospheric correction of Sentinel-2 level 1C products with ACOLITE.
+
+The products are split into groups, by tile, by orbit (datatake) or by overlapping footprints, and each group is
+processed by its own ACOLITE process in its own working directory, with a settings file limited to the bounding box of
+the group. Several ACOLITE processes run at the same time, ACOLITE itself runs on one core. The rhos_* outputs of the
+groups are then reprojected to a source raster and composited with Reproject_acolite.Acolite_reproject_stack_bands.
+"""
 from glob import glob
+import argparse
 import os
-from lxml.etree import parse
+import re
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import Polygon
 import numpy as np
 import subprocess
+from S2_safe import indexProducts, productName
+from Reproject_acolite import Acolite_reproject_stack_bands
+import Instrumentation
 
 def _polygon_from_coords(coords, fix_geom=False, swap=True, dims=2):
     """
@@ -33,36 +46,14 @@ def _polygon_from_coords(coords, fix_geom=False, swap=True, dims=2):
             raise RuntimeError("Geometry is not valid.")
 
 
-def get_bounding_boxS2(path):
+def _bounding_box(footprints):
     """
-    Function for creating bounding box for multiple S2 tiles (SAFE format), ACOLITE requires
-    bounding box for merging products, this finds the minimum bounding box that includes all the
-    products
-
-    :param path: path to folder with S2 level 1 products in SAFE format
-    :return: bounding box
+    Minimum bounding box (min lat, min lon, max lat, max lon) of footprints given as EXT_POS_LIST coordinates
     """
-
-    s2path = glob(os.path.join(path, 'S2*MSIL1C*'))
     footprint = []
-    for s2 in s2path:
-        manifest = os.path.join(s2, 'manifest.safe')
-        data_object_section = parse(manifest).find("dataObjectSection")
-        for data_object in data_object_section:
-            if data_object.attrib.get("ID") == "S2_Level-1C_Product_Metadata":
-                relpath = os.path.relpath(next(data_object.iter("fileLocation")).attrib["href"])
-                abspath = os.path.join(os.path.normpath(s2), relpath)
-        prod_meta = parse(abspath)
-
-        i = 0
-        for element in prod_meta.iter():
-            global_footprint = None
-            for global_footprint in element.iter("Global_Footprint"):
-                coords = global_footprint.findtext("EXT_POS_LIST").split()
-                coords = np.array(coords, dtype='float32')
-                if i == 0:
-                    footprint.append(_polygon_from_coords(coords))
-                i += 1
+    for coords in footprints:
+        coords = np.array(coords, dtype='float32')
+        footprint.append(_polygon_from_coords(coords))
     maxlon = []
     maxlat = []
     minlon = []
@@ -79,11 +70,38 @@ def get_bounding_boxS2(path):
     return bounding_box
 
 
+def get_bounding_boxS2(path, cache_path=None):
+    """
+    Function for creating bounding box for multiple S2 tiles (SAFE format), ACOLITE requires
+    bounding box for merging products, this finds the minimum bounding box that includes all the
+    products
+
+    :param path: path to folder with S2 level 1 products in SAFE format, extracted or zipped
+    :param cache_path: path to the metadata cache of the folder, see S2_safe.indexProducts
+    :return: bounding box
+    """
+
+    index = indexProducts(path, 'S2*MSIL1C*', cache_path=cache_path)
+    return _bounding_box([metadata['footprint'] for metadata in index.values()])
+
+
+def _settings(inputfiles, output, bounding_box, s2_target_res, merge_tiles=True):
+    """
+    Content of an ACOLITE settings file
+    """
+    return ('inputfile=' + ','.join(inputfiles) + '\n'
+            + 'output=' + output + '\n'
+            + 'limit=' + ', '.join(str(float(limit)) for limit in bounding_box) + '\n'
+            + 'l2w_parameters=rhos_*\n'
+            + 's2_target_res=' + str(s2_target_res) + '\n'
+            + 'merge_tiles=' + str(merge_tiles))
+
+
 def create_acolite_settings(inputfolder, output, s2_target_res, merge_tiles=True):
     """
     Create settings file for ACOLITE AC processor for multiple tiles and saves it in the
-    working directory as "aculite_settings.txt". For any other settings, look at the aculite_config.txt
-    in aculite_py_win/config folder
+    working directory as "acolite_settings.txt". For any other settings, look at the acolite_config.txt
+    in acolite_py_win/config folder
 
     :param inputfolder: folder with all the S2 level 1 products in SAFE format
     :param output: Output folder for
@@ -91,39 +109,168 @@ def create_acolite_settings(inputfolder, output, s2_target_res, merge_tiles=True
     :param merge_tiles: if you do not wish to merge, make this False
     :return: settings
     """
-    inputfiles = 'inputfile='
-    s2paths = glob(inputfolder + '\S2*MSIL1C*')
-    for s2 in s2paths:
-        inputfiles = inputfiles + s2 + ','
-
-    inputfiles = inputfiles[:-1] + '\n'
-    outputfile = 'output=' + output + '\n'
-    bounding_box = str(get_bounding_boxS2(inputfolder))[1:-1]
-    limit = 'limit=' + bounding_box + '\n'
-    l2w = 'l2w_parameters=rhos_*\n'
-    target_res = 's2_target_res=' + str(s2_target_res) + '\n'
-    merge = 'merge_tiles=' + str(merge_tiles)
-    settings = inputfiles + outputfile + limit + l2w + target_res + merge
+    s2paths = glob(os.path.join(inputfolder, 'S2*MSIL1C*'))
+    settings = _settings(s2paths, output, get_bounding_boxS2(inputfolder), s2_target_res, merge_tiles)
 
     with open("acolite_settings.txt", 'w') as dst:
         dst.write(settings)
 
     return settings
 
-cwd = os.getcwd()
-path = r"E:\MastersProjectData\SIT_S2\20190311_103537_103837_slstr_tti-color_500"
-dest = os.path.join(path, 'merged_ACOLITE')
-if not os.path.exists(dest):
-    os.mkdir(dest)
-settings = create_acolite_settings(path, dest, 60)
-settingsfp = os.path.abspath('aculite_settings.txt')
-acolitefp=r'acolite_py_win/dist/acolite'
-os.chdir(acolitefp)
-comm = r'acolite.exe --cli --settings="../../../acolite_settings.txt"'
-subprocess.run(comm, shell=True)
-os.chdir(cwd)
-destination = os.path.join(dest, 'merged.tif')
-destBands = os.path.join(dest, 'reproject_bands')
 
+group_modes = ('tile', 'orbit', 'overlap', 'all')
+
+
+def group_products(inputfolder, group_by='orbit', cache_path=None):
+    """
+    Split the S2 level 1 products of a folder into groups processed by separate ACOLITE processes
+
+    :param inputfolder: folder with the S2 level 1 products, extracted or zipped
+    :param group_by: 'tile' for one group per tile, 'orbit' for one group per datatake (platform, date and relative
+        orbit, the tiles ACOLITE can merge), 'overlap' for groups of products with overlapping footprints, or 'all'
+        for one group
+    :param cache_path: path to the metadata cache of the folder, see S2_safe.indexProducts
+    :return: dict of group name: list of (product path, footprint coordinates)
+    """
+    if group_by not in group_modes:
+        raise ValueError("Invalid grouping, choose one of these instead: {}".format(group_modes))
+    index = indexProducts(inputfolder, 'S2*MSIL1C*', cache_path=cache_path)
+    products = sorted(index.items())
+
+    if group_by == 'overlap':
+        # Connected components of the footprints that intersect
+        polygons = [_polygon_from_coords(np.array(metadata['footprint'], dtype='float32'))
+                    for prod, metadata in products]
+        parent = list(range(len(products)))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(products)):
+            for j in range(i + 1, len(products)):
+                if polygons[i].intersects(polygons[j]):
+                    parent[root(j)] = root(i)
+        keys = {}
+        names = [keys.setdefault(root(i), 'overlap_{}'.format(len(keys))) for i in range(len(products))]
+    elif group_by == 'tile':
+        names = [metadata['tile_id'] or productName(prod) for prod, metadata in products]
+    elif group_by == 'orbit':
+        names = []
+        for prod, metadata in products:
+            datatake = re.match(r'(S2[AB])_MSIL1C_(\d{8})T\d{6}_N\d{4}_(R\d{3})_', productName(prod))
+            names.append('_'.join(datatake.groups()) if datatake is not None else productName(prod))
+    else:
+        names = ['all'] * len(products)
+
+    groups = {}
+    for name, (prod, metadata) in zip(names, products):
+        groups.setdefault(name, []).append((prod, metadata['footprint']))
+    return groups
+
+
+def run_acolite(settings_path, workdir, acolite='acolite', log_name='acolite.log'):
+    """
+    Run ACOLITE on a settings file, with workdir as the working directory and its output logged in workdir
+
+    :param settings_path: path to the settings file
+    :param workdir: working directory of the process
+    :param acolite: ACOLITE executable, or a list with the command to run, e.g. [sys.executable, 'acolite_stub.py']
+    :param log_name: name of the log file in workdir
+    :return: subprocess.CompletedProcess, raises subprocess.CalledProcessError if ACOLITE fails
+    """
+    command = [acolite] if isinstance(acolite, str) else list(acolite)
+    command += ['--cli', '--settings=' + os.path.abspath(settings_path)]
+    with open(os.path.join(workdir, log_name), 'w') as log:
+        return subprocess.run(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+
+def process_acolite(inputfolder, destination, s2_target_res=60, group_by='orbit', workers=2, acolite='acolite',
+                    merge_tiles=True):
+    """
+    Atmospheric correction of the S2 level 1 products of a folder, with one ACOLITE process per group of products and
+    workers processes at the same time. Each group is processed in destination/<group name>, which holds its settings
+    file, log and output. A failing group is reported and does not stop the others
+
+    :param inputfolder: folder with the S2 level 1 products, extracted or zipped
+    :param destination: folder the working directories of the groups are created in
+    :param s2_target_res: resolution of the ACOLITE output, 10, 20 or 60
+    :param group_by: grouping of the products, see group_products
+    :param workers: number of ACOLITE processes run at the same time
+    :param acolite: ACOLITE executable or command, see run_acolite
+    :param merge_tiles: let ACOLITE merge the tiles of a group
+    :return: list of the output folders of the groups with rhos_* outputs, in the order of the group names
+    """
+    groups = group_products(inputfolder, group_by=group_by)
+    if len(groups) == 0:
+        raise ValueError("No S2 level 1 products found in {}".format(inputfolder))
+    if isinstance(acolite, str) and os.path.exists(acolite):
+        acolite = os.path.abspath(acolite)
+
+    def process(name, products):
+        workdir = os.path.join(destination, name)
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        settings_path = os.path.join(workdir, 'acolite_settings.txt')
+        with open(settings_path, 'w') as dst:
+            dst.write(_settings([os.path.abspath(prod) for prod, footprint in products], os.path.abspath(workdir),
+                                _bounding_box([footprint for prod, footprint in products]), s2_target_res,
+                                merge_tiles))
+        print("Running ACOLITE on {} products of {}".format(len(products), name))
+        with Instrumentation.stage('run_acolite', group=name):
+            run_acolite(settings_path, workdir, acolite)
+        return workdir
+
+    outputs = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(name, pool.submit(process, name, groups[name])) for name in sorted(groups)]
+        for name, future in futures:
+            try:
+                workdir = future.result()
+            except Exception as e:
+                print("ACOLITE failed for {}, {!r}".format(name, e))
+                continue
+            if len(glob(os.path.join(workdir, '*rhos_*.tif'))) == 0:
+                print("ACOLITE wrote no rhos_* outputs for {}".format(name))
+                continue
+            print("ACOLITE done for {}".format(name))
+            outputs.append(workdir)
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+
+    required.add_argument("--S2Source", help="Path to folder with the S2 level 1 products", required=True)
+    required.add_argument("--destination", help="Path to folder the ACOLITE outputs are written to", required=True)
+    required.add_argument("--resolution", default=60, type=int, choices=(10, 20, 60),
+                          help="Resolution of the ACOLITE output, default=60")
+    required.add_argument("--group_by", default="orbit", choices=group_modes,
+                          help="Products processed by the same ACOLITE process, default=orbit")
+    required.add_argument("--workers", default=2, type=int,
+                          help="Number of ACOLITE processes run at the same time, default=2")
+    required.add_argument("--acolite", default=os.path.join('acolite_py_win', 'dist', 'acolite', 'acolite.exe'),
+                          help="Path to the ACOLITE executable, default=acolite_py_win/dist/acolite/acolite.exe")
+    required.add_argument("--SrcPath", default=None,
+                          help="Raster the ACOLITE outputs are reprojected to and composited in destination/merged.tif, "
+                               "default=None (no reprojection)")
+    required.add_argument("--profile_out", default=None,
+                          help="Write the time, memory and I/O of each processing stage to this .json or .csv file, "
+                               "default=None")
+
+    args = parser.parse_args()
+    if args.profile_out is not None:
+        Instrumentation.enable()
+
+    outputs = process_acolite(args.S2Source, args.destination, s2_target_res=args.resolution,
+                              group_by=args.group_by, workers=args.workers, acolite=args.acolite)
 
+    if args.SrcPath is not None and len(outputs) > 0:
+        Acolite_reproject_stack_bands(args.SrcPath, outputs, os.path.join(args.destination, 'merged.tif'))
 
+    if args.profile_out is not None:
+        print("Processing profile written to: {}".format(Instrumentation.exportRecords(args.profile_out)))
@@ -0,0 +1,242 @@
+"""
+Batch version of Mask_S2_Overlap.py and S2_Reproject_Merge.py, processing many masks in a single interpreter.
+
+The masks are given by a glob (--Masks) or a manifest (--Manifest), a text file with one mask per line:
+
+    mask[,S2Source,destination]
+
+When S2Source and destination are given, the S2 products found in S2Source are reprojected and merged to the grid of
+the mask, as S2_Reproject_Merge.py does. With --download the overlapping products are first downloaded to S2Source,
+and each product is reprojected as soon as it is downloaded. With --archive the overlapping products are selected from
+a local archive instead of the hub, and S2Source can be left empty ('mask,,destination') to merge them straight from
+the archive. Lines starting with # are ignored. The login to the hub, or the archive index, and the CRS definitions are
+shared by all masks, and --workers masks are processed at the same time.
+"""
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from queue import Queue
+from threading import Thread
+
+from sentinelsat import SentinelAPI
+
+import Instrumentation
+from Mask_S2_Overlap import findS2Products, parseUserPass
+from S2_Reproject_Merge import ProcessS2Products, merge_methods, output_dtypes, selectBands
+from S2_archive import buildArchiveIndex
+from S2_download import downloadProducts, iterQueue
+
+
+def readManifest(path):
+    """
+    Read a manifest of masks
+
+    :param path: path to the manifest, one 'mask[,S2Source,destination]' per line
+    :return: list of (mask, S2Source, destination), S2Source and destination are None when not given or empty
+    """
+    jobs = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            row = [field.strip() for field in row]
+            if len(row) == 0 or row[0] == '' or row[0].startswith('#'):
+                continue
+            if len(row) not in (1, 3):
+                raise ValueError("Manifest lines must be 'mask' or 'mask,S2Source,destination', got: {}"
+                                 .format(",".join(row)))
+            jobs.append((row[0], None, None) if len(row) == 1 else tuple(field or None for field in row))
+    return jobs
+
+
+def processMask(job, api, search_kwargs, merge_kwargs, download_kwargs=None):
+    """
+    Search the overlapping S2 products of one mask, then reproject and merge them if the job has an S2 source
+
+    :param job: (mask, S2Source, destination)
+    :param api: SentinelAPI session shared by all masks, None when offline
+    :param search_kwargs: keyword arguments of Mask_S2_Overlap.findS2Products
+    :param merge_kwargs: keyword arguments of S2_Reproject_Merge.ProcessS2Products
+    :param download_kwargs: keyword arguments of S2_download.downloadProducts. If given, the overlapping products are
+        downloaded to S2Source and each product is reprojected as soon as it is downloaded, while the next ones are
+        still downloading
+    :return: (kept_products, path to merged.tif or None)
+    """
+    mask, S2Source, destination = job
+    with Instrumentation.stage('processMask', mask=os.path.basename(mask)):
+        kept_products = findS2Products(mask, api, **search_kwargs)
+        merged = None
+        if S2Source is not None and download_kwargs is not None:
+            products = Queue()
+            download = Thread(target=downloadProducts, args=(kept_products, S2Source),
+                              kwargs=dict(download_kwargs, api=api, queue=products))
+            download.start()
+            try:
+                merged = ProcessS2Products(mask, iterQueue(products), destination, **merge_kwargs)
+            finally:
+                download.join()
+        elif S2Source is not None:
+            merged = ProcessS2Products(mask, S2Source, destination, **merge_kwargs)
+        elif destination is not None and search_kwargs.get('archive') is not None:
+            # The products are read where they are in the archive
+            merged = ProcessS2Products(mask, [prod['path'] for prod in kept_products], destination, **merge_kwargs)
+    return kept_products, merged
+
+
+def batchProcess(jobs, api, workers=1, search_kwargs=None, merge_kwargs=None, download_kwargs=None):
+    """
+    Process masks with a bounded pool of workers, a failing mask is reported and does not stop the batch
+
+    :param jobs: list of (mask, S2Source, destination)
+    :param api: SentinelAPI session shared by all masks, None when offline
+    :param workers: number of masks processed at the same time
+    :param search_kwargs: keyword arguments of Mask_S2_Overlap.findS2Products
+    :param merge_kwargs: keyword arguments of S2_Reproject_Merge.ProcessS2Products
+    :param download_kwargs: keyword arguments of S2_download.downloadProducts, see processMask
+    :return: list with a dict {'mask', 'products', 'merged', 'error'} per job, in the order of jobs
+    """
+    search_kwargs = search_kwargs or {}
+    merge_kwargs = merge_kwargs or {}
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(job[0], pool.submit(processMask, job, api, search_kwargs, merge_kwargs, download_kwargs))
+                   for job in jobs]
+        for mask, future in futures:
+            try:
+                kept_products, merged = future.result()
+                results.append({'mask': mask, 'products': kept_products, 'merged': merged, 'error': None})
+                print("{}: {} overlapping products".format(os.path.basename(mask), len(kept_products)))
+            except Exception as e:
+                results.append({'mask': mask, 'products': [], 'merged': None, 'error': repr(e)})
+                print("{}: failed, {!r}".format(os.path.basename(mask), e))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+
+    required.add_argument("--Masks", help="Glob of mask rasters, e.g. 'masks/*.tif'")
+    required.add_argument("--Manifest", help="Text file with one 'mask[,S2Source,destination]' per line")
+    required.add_argument("--output", help="JSON file the overlapping products of every mask are written to",
+                          required=True)
+    required.add_argument("--workers", default=4, type=int, help="Number of masks processed at the same time, default=4")
+    required.add_argument('--ValidInterval', nargs='+', type=int, default=(0,0), help="Interval of values from mask")
+    required.add_argument('--ValidValues', '--list', nargs='+', default=(), type=int, help="Valid values for mask")
+    required.add_argument('--cloudcover', default=(0,30), help="Cloud cover percentage (min, max)")
+    required.add_argument('--delta', default="hours=1", help="Time difference from SIT product")
+    required.add_argument('--credentials',
+                          help="Path to .txt file specifying username and password for copernicus.com, required unless --offline "
+                               "or --archive")
+    required.add_argument('--minS2pixels', default=2000, type=int, help="Minimum amount of valid pixels in S2 product,"
+                                                                      "default=2000")
+    required.add_argument('--minS2pixelPerc', default=20, type=int, help="Minimum percentage of valid pixels in S2 product, default=20")
+    required.add_argument('--FootprintMode', default='edges', choices=('edges', 'outline', 'full'),
+                          help="Footprint from the raster edges, the valid data outline or every pixel, default=edges")
+    required.add_argument('--FootprintStep', default=100, type=int,
+                          help="Distance in pixels between footprint vertices, default=100")
+    required.add_argument('--cache_dir', default=None,
+                          help="Directory of the query cache, default=None (no cache)")
+    required.add_argument('--cache_ttl', default=24, type=float,
+                          help="Hours a cached query result is valid, default=24")
+    required.add_argument('--cache_max_size', default=100, type=float,
+                          help="Size of the query cache in MB, default=100")
+    required.add_argument('--offline', action='store_true',
+                          help="Only use cached query results, never connect to the hub")
+    required.add_argument('--archive', default=None,
+                          help="Directory of S2 products the overlapping products are selected from, instead of "
+                               "querying the hub, default=None")
+    required.add_argument("--ProcessingLevel", help="Specify S2 processing level, default=L1C", default="L1C")
+    required.add_argument('--bands', '--names-list', nargs='+', default=['all'],
+                          help="Define bands you want to keep, default=all")
+    required.add_argument('--resampling', default="nearest",
+                          help="Resampling method to use from rasterio.warp.Resampling, default=nearest")
+    required.add_argument('--merge_method', default="first", choices=merge_methods,
+                          help="Compositing of overlapping valid pixels in the merge, default=first")
+    required.add_argument('--direct_merge', action='store_true',
+                          help="Reproject all products directly into merged.tif, without per-product rasters")
+    required.add_argument('--decimate', action='store_true',
+                          help="Read the bands at a reduced resolution close to the pixel size of the mask")
+    required.add_argument('--window_warp', action='store_true',
+                          help="Warp each product into the window of the mask overlapping it only, faster but not "
+                               "identical to warping into the whole grid")
+    required.add_argument('--tiled', action='store_true', help="Write the output rasters with internal tiling")
+    required.add_argument('--compress', default=None,
+                          help="Compression of the output rasters, e.g. deflate, lzw, zstd or lerc, default=None")
+    required.add_argument('--blocksize', default=256, type=int,
+                          help="Width and height of the blocks of tiled output rasters, default=256")
+    required.add_argument('--max_z_error', default=0, type=float,
+                          help="Maximum error of LERC compression, default=0 (lossless)")
+    required.add_argument('--overviews', action='store_true', help="Build internal overviews in merged.tif")
+    required.add_argument('--cog', action='store_true',
+                          help="Write merged.tif as a Cloud Optimized GeoTIFF, with overviews")
+    required.add_argument('--dtype', default='float32', choices=output_dtypes,
+                          help="Data type of the output rasters, float32 TOA reflectance or the uint16/int16 DN with "
+                               "a reflectance scale in the metadata, default=float32")
+    required.add_argument('--keep_temporary', action='store_true',
+                          help="Keep the stacked rasters in destination/tmp, a later run only reprocesses new or "
+                               "changed products")
+    required.add_argument('--download', action='store_true',
+                          help="Download the overlapping products of each manifest line to its S2Source, each product "
+                               "is reprojected as soon as it is downloaded")
+    required.add_argument('--download_workers', default=2, type=int,
+                          help="Number of products downloaded at the same time for each mask, default=2")
+    required.add_argument('--unzip', action='store_true',
+                          help="Extract the downloaded products, zipped products are otherwise read directly")
+    required.add_argument('--profile_out', default=None,
+                          help="Write the time, memory and I/O of each processing stage to this .json or .csv file, "
+                               "default=None")
+
+    args = parser.parse_args()
+    if args.profile_out is not None:
+        Instrumentation.enable()
+
+    if (args.Masks is None) == (args.Manifest is None):
+        raise ValueError("Need input for either --Masks or --Manifest")
+    if (args.credentials is None) and not args.offline and (args.archive is None):
+        raise ValueError("Need input for --credentials, unless running --offline or with --archive")
+    if (args.offline or (args.archive is not None)) and args.download:
+        raise ValueError("Can not --download when running --offline or with --archive")
+
+    if args.Manifest is not None:
+        jobs = readManifest(args.Manifest)
+    else:
+        jobs = [(mask, None, None) for mask in sorted(glob(args.Masks))]
+    if len(jobs) == 0:
+        raise ValueError("No masks found")
+
+    # One login for every mask
+    if args.offline or (args.archive is not None):
+        Sentinel2api = None
+    else:
+        user, password = parseUserPass(args.credentials)
+        Sentinel2api = SentinelAPI(user, password)
+
+    search_kwargs = {'validvals': args.ValidValues, 'validinterval': args.ValidInterval, 'delta': args.delta,
+                     'cloudcover': args.cloudcover, 'minS2pixels': args.minS2pixels,
+                     'minS2pixelPerc': args.minS2pixelPerc, 'footprintMode': args.FootprintMode,
+                     'footprintStep': args.FootprintStep, 'cache_dir': args.cache_dir,
+                     'cache_ttl': args.cache_ttl * 3600, 'cache_max_size': args.cache_max_size * 1e6,
+                     'offline': args.offline,
+                     'archive': None if args.archive is None else buildArchiveIndex(args.archive, '*MSIL1C*')}
+    merge_kwargs = {'procLevel': args.ProcessingLevel, 'bands_name': selectBands(args.ProcessingLevel, args.bands),
+                    'resampling': args.resampling, 'method': args.merge_method, 'direct_merge': args.direct_merge,
+                    'decimate': args.decimate, 'keep_temporary': args.keep_temporary, 'tiled': args.tiled,
+                    'compress': args.compress, 'blocksize': args.blocksize, 'max_z_error': args.max_z_error,
+                    'overviews': args.overviews, 'cog': args.cog, 'dtype': args.dtype,
+                    'window_warp': args.window_warp}
+
+    print("Processing {} masks with {} workers...".format(len(jobs), args.workers))
+    download_kwargs = {'workers': args.download_workers, 'unzip': args.unzip} if args.download else None
+    results = batchProcess(jobs, Sentinel2api, workers=args.workers, search_kwargs=search_kwargs,
+                           merge_kwargs=merge_kwargs, download_kwargs=download_kwargs)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+
+    failed = [result['mask'] for result in results if result['error'] is not None]
+    print("Done, {} of {} masks failed, results written to: {}".format(len(failed), len(results), args.output))
+    if args.profile_out is not None:
+        print("Processing profile written to: {}".format(Instrumentation.exportRecords(args.profile_out)))
@@ -0,0 +1,84 @@
+"""
+Shared registry of pyproj CRS and Transformer objects.
+
+Parsing a CRS and setting up a transformation is done once per (source CRS, destination CRS) and the result is reused
+by every footprint and geometry transform in the interpreter. pyproj CRS and Transformer objects are thread-safe from
+pyproj 3.1, so the registry can be shared by the workers of a batch.
+"""
+from functools import lru_cache
+
+import numpy as np
+import shapely
+import shapely.geometry
+import shapely.ops
+from pyproj import CRS, Transformer
+
+
+def _crsKey(crs):
+    """
+    Hashable key of a CRS given as a rasterio or pyproj CRS, a dict of PROJ parameters or a string (EPSG:xxxx,
+    PROJ string or WKT)
+    """
+    if isinstance(crs, dict):
+        return tuple(sorted(crs.items()))
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    return str(crs)
+
+
+@lru_cache(maxsize=64)
+def _cachedCRS(key):
+    return CRS.from_user_input(dict(key) if isinstance(key, tuple) else key)
+
+
+@lru_cache(maxsize=64)
+def _cachedTransformer(src_key, dst_key):
+    return Transformer.from_crs(_cachedCRS(src_key), _cachedCRS(dst_key), always_xy=True)
+
+
+def getCRS(crs):
+    """
+    Get the pyproj CRS of a CRS, parsed once per CRS
+
+    :param crs: rasterio or pyproj CRS, dict of PROJ parameters or string
+    :return: pyproj.CRS
+    """
+    return _cachedCRS(_crsKey(crs))
+
+
+def getTransformer(src_crs, dst_crs):
+    """
+    Get the transformer between two CRS, created once per (src_crs, dst_crs). Coordinates are always in x, y
+    (longitude, latitude) order.
+
+    :param src_crs: source CRS, see getCRS
+    :param dst_crs: destination CRS, see getCRS
+    :return: pyproj.Transformer
+    """
+    return _cachedTransformer(_crsKey(src_crs), _crsKey(dst_crs))
+
+
+def transformGeometries(src_crs, dst_crs, geometries):
+    """
+    Transform geometries between two CRS, the coordinates of all geometries are transformed in one call
+
+    :param src_crs: source CRS, see getCRS
+    :param dst_crs: destination CRS, see getCRS
+    :param geometries: shapely or GeoJSON-like geometries
+    :return: list of GeoJSON-like geometries in dst_crs
+    """
+    transformer = getTransformer(src_crs, dst_crs)
+    shapes = [geom if isinstance(geom, shapely.geometry.base.BaseGeometry) else shapely.geometry.shape(geom)
+              for geom in geometries]
+    if len(shapes) == 0:
+        return []
+
+    if hasattr(shapely, 'get_coordinates'):
+        # Shapely 2: gather the coordinates of all geometries in one array
+        coords = shapely.get_coordinates(shapes)
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        shapes = shapely.set_coordinates(np.array(shapes, dtype=object), np.column_stack((x, y)))
+    else:
+        shapes = [shapely.ops.transform(transformer.transform, geom) for geom in shapes]
+
+    return [shapely.geometry.mapping(geom) for geom in shapes]
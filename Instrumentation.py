@@ -0,0 +1,294 @@
+"""
+Per-stage instrumentation of the pipeline: wall time, memory and I/O of each stage, exported to JSON or CSV.
+
+Stages are recorded with the stage context manager or the instrumented decorator, and only while recording is enabled,
+otherwise they cost a function call. For instance:
+
+    Instrumentation.enable()
+    with Instrumentation.stage('warp', product=prod_name):
+        ...
+    Instrumentation.exportRecords('profile.json')
+
+Each record has the stage name, its parent stage in the same thread, the thread, the start time relative to enable and
+the wall time, the resident memory (RSS) at the start and end and the peak RSS during the stage, and the bytes read
+and written during the stage: read_chars/write_chars by system calls (including reads served from the page cache) and
+read_bytes/write_bytes from storage. Memory and I/O are read from /proc/self on Linux, and from psutil elsewhere when
+it is installed, otherwise they are None. The peak RSS of a stage needs the high-water mark of the process to be reset
+at the start of the stage, through /proc/self/clear_refs, so it is None where that is not possible. Memory and I/O
+are counted for the whole process, so the counts of stages running at the same time in other threads overlap.
+"""
+import csv
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_lock = threading.Lock()
+_local = threading.local()
+_records = []
+_enabled = False
+_origin = 0.0
+# Stages started since the high-water mark of the RSS was reset, by id of their token
+_peak_stages = {}
+_peak_reset = os.path.exists('/proc/self/clear_refs')
+
+record_fields = ['stage', 'parent', 'thread', 'start', 'wall_time', 'rss_start', 'rss_end', 'peak_rss',
+                 'read_chars', 'write_chars', 'read_bytes', 'write_bytes']
+
+
+def enable():
+    """
+    Start recording stages, the start times of the records are relative to this call
+    """
+    global _enabled, _origin
+    _origin = time.perf_counter()
+    _enabled = True
+
+
+def disable():
+    """
+    Stop recording stages, the records are kept
+    """
+    global _enabled
+    _enabled = False
+
+
+def isEnabled():
+    """
+    True while stages are recorded
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Remove the records
+    """
+    with _lock:
+        del _records[:]
+
+
+def records():
+    """
+    Copy of the records, in the order the stages finished
+
+    :return: list of dicts
+    """
+    with _lock:
+        return [dict(record) for record in _records]
+
+
+def _memory():
+    """
+    Current and peak resident memory of the process in bytes
+    """
+    try:
+        with open('/proc/self/status') as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+        return int(fields['VmRSS'].split()[0]) * 1024, int(fields['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    rss = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        rss, peak = info.rss, getattr(info, 'peak_wset', None)
+    if peak is None and resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return rss, peak
+
+
+def _startPeak(token):
+    """
+    Reset the high-water mark of the RSS at the start of a stage, after keeping it as the peak so far of the stages
+    already started
+    """
+    global _peak_reset
+    with _lock:
+        if not _peak_reset:
+            return
+        peak = _memory()[1]
+        for other in _peak_stages.values():
+            other['peak'] = max(other['peak'], peak or 0)
+        try:
+            with open('/proc/self/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            _peak_reset = False
+            _peak_stages.clear()
+            return
+        token['peak'] = 0
+        _peak_stages[id(token)] = token
+
+
+def _stopPeak(token):
+    """
+    Peak RSS during a stage started with _startPeak, None if the high-water mark could not be reset
+    """
+    with _lock:
+        if _peak_stages.pop(id(token), None) is None:
+            return None
+        peak = _memory()[1]
+        return None if peak is None else max(token['peak'], peak)
+
+
+def _io():
+    """
+    Bytes read and written by the process: (read_chars, write_chars, read_bytes, write_bytes)
+    """
+    try:
+        with open('/proc/self/io') as io:
+            fields = dict(line.split(':', 1) for line in io)
+        return tuple(int(fields[name]) for name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'))
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return (getattr(counters, 'read_chars', None), getattr(counters, 'write_chars', None),
+                    counters.read_bytes, counters.write_bytes)
+        except (AttributeError, psutil.Error):
+            pass
+    return None, None, None, None
+
+
+def _difference(end, start):
+    return None if end is None or start is None else end - start
+
+
+def startStage(name, **tags):
+    """
+    Start a stage that does not fit in a with block, e.g. a product whose bands are processed by a pool
+
+    :param name: name of the stage
+    :param tags: extra fields of the record, e.g. product=prod_name
+    :return: token for stopStage, None when recording is disabled
+    """
+    if not _enabled:
+        return None
+    stack = getattr(_local, 'stack', None)
+    token = {'stage': name, 'parent': stack[-1] if stack else None, 'thread': threading.current_thread().name,
+             'tags': tags, 'start': time.perf_counter(), 'rss': _memory()[0], 'io': _io()}
+    _startPeak(token)
+    return token
+
+
+def stopStage(token, **tags):
+    """
+    Stop a stage started with startStage and record it
+
+    :param token: token returned by startStage
+    :param tags: extra fields of the record, added to the ones given to startStage
+    :return: the record, None when recording was disabled at the start of the stage
+    """
+    if token is None:
+        return None
+    end = time.perf_counter()
+    rss = _memory()[0]
+    peak = _stopPeak(token)
+    io = _io()
+
+    record = {'stage': token['stage'], 'parent': token['parent'], 'thread': token['thread'],
+              'start': token['start'] - _origin, 'wall_time': end - token['start'],
+              'rss_start': token['rss'], 'rss_end': rss, 'peak_rss': peak}
+    for field, start_count, end_count in zip(record_fields[-4:], token['io'], io):
+        record[field] = _difference(end_count, start_count)
+    record.update(token['tags'])
+    record.update(tags)
+    with _lock:
+        _records.append(record)
+    return record
+
+
+@contextmanager
+def stage(name, **tags):
+    """
+    Record the block as a stage, see startStage. Stages started in the block, in the same thread, have it as parent
+
+    :param name: name of the stage
+    :param tags: extra fields of the record
+    """
+    token = startStage(name, **tags)
+    if token is None:
+        yield
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+        stopStage(token)
+
+
+def instrumented(name=None):
+    """
+    Decorator recording each call of a function as a stage
+
+    :param name: name of the stage, default the name of the function
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """
+    Total wall time and number of calls of each stage
+
+    :return: dict of stage name: {'calls', 'wall_time'}
+    """
+    totals = {}
+    for record in records():
+        total = totals.setdefault(record['stage'], {'calls': 0, 'wall_time': 0.0})
+        total['calls'] += 1
+        total['wall_time'] += record['wall_time']
+    return totals
+
+
+def exportRecords(path):
+    """
+    Write the records to a JSON file, or to a CSV file if path ends with .csv
+
+    :param path: path of the file
+    :return: path
+    """
+    data = records()
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    if path.lower().endswith('.csv'):
+        fields = list(record_fields)
+        for record in data:
+            fields += [field for field in record if field not in fields]
+        with open(path, 'w', newline='') as dst:
+            writer = csv.DictWriter(dst, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(data)
+    else:
+        with open(path, 'w') as dst:
+            json.dump({'records': data, 'summary': summary()}, dst, indent=1, default=str)
+    return path
@@ -1,72 +1,133 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import argparse
 import rasterio
 from glob import glob
 import os
-import rasterio.warp as warp
-import rasterio.mask
+import rasterio.features
+import rasterio.windows
+from rasterio.windows import Window
+from rasterio.enums import MergeAlg
+from rasterio.errors import WindowError
 from affine import Affine
-from pyproj import Proj, transform
 import shapely.wkt
-from shapely.geometry import mapping
+import shapely.geometry
 import dateparser
 import numpy as np
 from geojson import dump
 from sentinelsat import SentinelAPI, geojson_to_wkt
 from datetime import timedelta
+import hashlib
+import json
+import pickle
+import tempfile
+import time
+from CRS_transform import getTransformer, transformGeometries
+from S2_download import downloadProducts
+from S2_archive import buildArchiveIndex, queryArchive
+import Instrumentation
+from Instrumentation import instrumented
+
+
+def _footprintEdgePixels(height, width, step=100):
+	"""
+		Row and column indices of the raster edge pixels, sampled every 'step' pixels. The edges are walked in the same
+		order as the full grid footprint: down the first column, along the last row, up the last column and back
+		along the first row to the starting pixel.
+	"""
+	rows = np.arange(0, height, step)
+	cols = np.arange(0, width, step)
+
+	edge_rows = np.concatenate((rows, np.full(cols.shape, height - 1), rows[::-1], np.zeros(cols.shape, dtype=int)))
+	edge_cols = np.concatenate((np.zeros(rows.shape, dtype=int), cols, np.full(rows.shape, width - 1), cols[::-1]))
+
+	return edge_rows, edge_cols
+
+
+def _footprintOutline(r, step=100):
+	"""
+		Eastings and northings of the outline of the valid data in raster r. The dataset mask is read decimated by
+		'step' so memory use is bounded by the decimated grid, the outline is accurate to about 'step' pixels.
+	"""
+	out_shape = (int(np.ceil(r.height / step)), int(np.ceil(r.width / step)))
+	valid = r.read_masks(1, out_shape=out_shape)
+	T = r.transform * Affine.scale(r.width / out_shape[1], r.height / out_shape[0])
+
+	polygons = [shapely.geometry.shape(shape) for shape, value in
+				rasterio.features.shapes(valid, mask=valid > 0, transform=T)]
+	if len(polygons) == 0:
+		raise ValueError("No valid data found in {}".format(r.name))
+	outline = max(polygons, key=lambda poly: poly.area)
+
+	# Remove the staircase from the decimated pixel edges
+	outline = outline.simplify(max(abs(T.a), abs(T.e)) / 2, preserve_topology=True)
+	eastings, northings = _densifyRing(np.array(outline.exterior.coords),
+									   step * min(abs(r.transform.a), abs(r.transform.e))).T
+
+	return eastings, northings
+
+
+def _densifyRing(coords, spacing):
+	"""
+		Vertices of the closed ring coords with extra vertices at most 'spacing' apart along each segment, so the
+		straight edges of a polar grid stay straight in the grid once the footprint is joined in longitude/latitude.
+	"""
+	starts, ends = coords[:-1], coords[1:]
+	counts = np.maximum(np.ceil(np.hypot(*(ends - starts).T) / spacing).astype(int), 1)
+
+	segments = [start + (end - start) * (np.arange(count) / count)[:, None]
+				for start, end, count in zip(starts, ends, counts)]
+
+	return np.concatenate(segments + [coords[-1:]])
+
+
+@instrumented()
+def createFootprint(pathname, saveasGeojson=True, name=None, mode='edges', step=100):
+	"""
+		Create the footprint of the raster in pathname as a GeoJSON polygon in longitude/latitude.
+
+		pathname: Path to raster.
+		saveasGeojson: Write the footprint to name + '.geojson'
+		name: Name of the GeoJSON file, without extension
+		mode: 'edges' reprojects only the edge pixel centres, 'outline' traces the outline of the valid data and
+			'full' reprojects every pixel centre of the raster (slow and memory hungry, kept for reference).
+		step: Distance in pixels between the footprint vertices along the edges, or the decimation of the dataset
+			mask for 'outline'.
+
+		Returns lonlat, the longitudes/latitudes of the footprint vertices (of every pixel for mode='full'), and geom.
+	"""
+	if mode not in ('edges', 'outline', 'full'):
+		raise ValueError("Invalid footprint mode, choose one of these instead: ('edges', 'outline', 'full')")
 
-parser = argparse.ArgumentParser(description=__doc__)
-optional = parser._action_groups.pop()
-required = parser.add_argument_group("required arguments")
-
-required.add_argument("--MaskPath", help="Path to mask product", required=True)
-required.add_argument("--ValidInterval", nargs="+",type=int, default=[0,0], help="Interval of values from mask")
-required.add_argument("--ValidValues",'--list', nargs='+',type=int,default=[], help='Valid values for mask')
-required.add_argument("--cloudcover",default=(0,30), help="Cloud cover percentage (min, max)")
-required.add_argument("--delta", default="hours=1", help="Time difference from SIT product")
-required.add_argument("--credentials", help="Path to .txt file specifying username and password for copernicus.com",
-					  required=True)
-required.add_argument("--minS2pixels", default=2000, type=int, 
-					  help="Minimum amount of valid pixels in S2 product,default=2000")
-required.add_argument("--minS2pixelPerc", default=20, type=int, 
-					  help="Minimum percentage of valid pixels in S2 product, default=20")
-					  
-args = parser.parse_args()
-cloudcover = args.cloudcover
-path = args.MaskPath
-txtpath = args.credentials
-delta = args.delta
-validvals = args.ValidValues
-validinterval = args.ValidInterval
-minS2pixels=args.minS2pixels
-minS2pixelPerc = args.minS2pixelPerc
-
-
-if (len(validvals) == 0) and (sum(validinterval)==0):
-	raise ValueError("Need input for either --ValidInterval or --ValidValues")
-	
-
-def createFootprint(pathname, saveasGeojson=True, name=None):
 	# Read raster
 	with rasterio.open(pathname) as r:
 		T0 = r.transform  # upper-left pixel corner affine transform
-		p1 = Proj(r.crs)
-		A = r.read(1)  # pixel values
-
-	# All rows and columns
-	cols, rows = np.meshgrid(np.arange(A.shape[1]), np.arange(A.shape[0]))
+		crs = r.crs
+		shape = r.shape
+		if mode == 'full':
+			A = r.read(1)  # pixel values
+			shape = A.shape
+		elif mode == 'outline':
+			eastings, northings = _footprintOutline(r, step=step)
 
 	# Get affine transform for pixel centres
 	T1 = T0 * Affine.translation(0.5, 0.5)
-	# Function to convert pixel row/column index (from 0) to easting/northing at centre
-	rc2en = lambda r, c: (c, r) * T1
 
-	# All eastings and northings (there is probably a faster way to do this)
-	eastings, northings = np.vectorize(rc2en, otypes=[np.float, np.float])(rows, cols)
+	if mode == 'full':
+		# All rows and columns
+		cols, rows = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+
+		# Function to convert pixel row/column index (from 0) to easting/northing at centre
+		rc2en = lambda r, c: T1 * (c, r)
 
-	# Project all longitudes, latitudes
-	p2 = Proj(proj='latlong', datum='WGS84')
-	longs, lats = transform(p1, p2, eastings, northings)
+		# All eastings and northings
+		eastings, northings = np.vectorize(rc2en, otypes=[float, float])(rows, cols)
+	elif mode == 'edges':
+		rows, cols = _footprintEdgePixels(shape[0], shape[1], step=step)
+		eastings = cols * T1.a + rows * T1.b + T1.c
+		northings = cols * T1.d + rows * T1.e + T1.f
+
+	# Project longitudes, latitudes
+	longs, lats = getTransformer(crs, 'EPSG:4326').transform(eastings, northings)
 
 	lonlat = np.zeros((longs.shape + (2,)))
 
@@ -79,13 +140,17 @@ def createFootprint(pathname, saveasGeojson=True, name=None):
 		with open(fp, 'w') as outfile:
 			dump(geom_in_geojson, outfile)
 
-	right = lonlat[:, 0, :][0::100]  # right
-	down = lonlat[-1, :, :][0::100]  # down
-	left = np.flip(lonlat[:, -1, :][0::100], axis=0)  # left
-	up = np.flip(lonlat[0, :, :][0::100], axis=0)  # up
-	up[-1] = right[0]
+	if mode == 'full':
+		right = lonlat[:, 0, :][0::step]  # right
+		down = lonlat[-1, :, :][0::step]  # down
+		left = np.flip(lonlat[:, -1, :][0::step], axis=0)  # left
+		up = np.flip(lonlat[0, :, :][0::step], axis=0)  # up
+		up[-1] = right[0]
+
+		footprint_arr = np.concatenate((right, down, left, up), axis=0).tolist()
+	else:
+		footprint_arr = lonlat.tolist()
 
-	footprint_arr = np.concatenate((right, down, left, up), axis=0).tolist()
 	geom = {
 		"type": "FeatureCollection",
 		"features": [
@@ -139,47 +204,300 @@ def deltaTimeSIT(path, delta="hours=1"):
 	return starttime, endtime
 
 
-def createSITMask(path, name='SIT_pixels'):
-	print("Creating temperorary SIT mask raster...")
-	# Creating the SIT mask and writing it as raster
-	with rasterio.open(path) as r:
-		kwds = r.profile
+SITMask = namedtuple('SITMask', ['valid', 'data', 'shape', 'transform', 'crs'])
+
+
+def _validPixels(data, validvals=(), validinterval=(0, 0)):
+	if len(validvals) == 0:
+		return (data >= validinterval[0]) & (data <= validinterval[1])
+	else:
+		return np.isin(data, validvals)
 
-		data = r.read(1)
-		
-		if len(validvals) == 0:
-			SIT_pixels = ((data >= validinterval[0]) & (data <= validinterval[1])).astype(np.uint8) * 100
-		else:
-			SIT_pixels = np.isin(data, validvals)*100
 
-		with rasterio.open(name + '.tif', 'w', **kwds) as d:
-			d.write(SIT_pixels, 1)
-	print('Creating raster, done.')
+@instrumented()
+def createSITMask(path, validvals=(), validinterval=(0, 0)):
+	"""
+		Create the mask of valid SIT pixels of the raster in path. The raster is read block by block, so peak memory
+		is bounded by the block size of the raster and not the size of the scene.
 
+		path: Path to mask raster
+		validvals: Valid values of the mask, if empty the pixels within validinterval are valid
+		validinterval: Interval (min, max) of valid values
 
-def searchSITPixels(pathSIT, S2Odict, minSIT_pixels=2000, minSIT_percent=20):
+		Returns a SITMask where valid and data are bit packed rows (np.packbits along the columns) of the valid pixels
+		and of the pixels that are not nodata, data is None if the raster has no nodata value.
+	"""
+	print("Creating SIT mask...")
+	with rasterio.open(path) as r:
+		height, width = r.shape
+		valid = np.zeros((height, (width + 7) // 8), dtype=np.uint8)
+		data = None if r.nodata is None else np.zeros_like(valid)
+
+		# Packing requires blocks starting on a byte boundary, otherwise read full width strips
+		blockysize, blockxsize = r.block_shapes[0]
+		if blockxsize % 8 == 0:
+			windows = (window for ij, window in r.block_windows(1))
+		else:
+			windows = (Window(0, row, width, min(blockysize, height - row)) for row in range(0, height, blockysize))
+
+		for window in windows:
+			block = r.read(1, window=window)
+			rows = slice(window.row_off, window.row_off + window.height)
+			cols = slice(window.col_off // 8, (window.col_off + window.width + 7) // 8)
+
+			valid[rows, cols] = np.packbits(_validPixels(block, validvals, validinterval), axis=1)
+			if data is not None:
+				data[rows, cols] = np.packbits(block != r.nodata, axis=1)
+
+		SIT_mask = SITMask(valid, data, (height, width), r.transform, r.crs)
+	print('Creating mask, done.')
+
+	return SIT_mask
+
+
+def readSITMask(SIT_mask, window):
+	"""
+		Unpack the window of a SITMask, returns boolean arrays of the valid pixels and of the pixels that are not nodata
+	"""
+	rows = slice(window.row_off, window.row_off + window.height)
+	cols = slice(window.col_off // 8, (window.col_off + window.width + 7) // 8)
+	offset = window.col_off % 8
+
+	valid = np.unpackbits(SIT_mask.valid[rows, cols], axis=1)[:, offset:offset + window.width].astype(bool)
+	if SIT_mask.data is None:
+		data = np.ones(valid.shape, dtype=bool)
+	else:
+		data = np.unpackbits(SIT_mask.data[rows, cols], axis=1)[:, offset:offset + window.width].astype(bool)
+
+	return valid, data
+
+
+def _footprintWindow(bounds, transform, shape):
+	"""
+		Window of the raster grid given by transform and shape covering bounds, None if they do not intersect
+	"""
+	window = rasterio.windows.from_bounds(*bounds, transform=transform)
+	col_off, row_off = int(np.floor(window.col_off)), int(np.floor(window.row_off))
+	window = Window(col_off, row_off, int(np.ceil(window.col_off + window.width)) - col_off,
+					int(np.ceil(window.row_off + window.height)) - row_off)
+	try:
+		return window.intersection(Window(0, 0, shape[1], shape[0]))
+	except WindowError:
+		return None
+
+
+def countSITPixels(SIT_mask, geometries, strip_height=512):
+	"""
+		Count the valid and invalid (not valid and not nodata) pixels of a SITMask within each of the geometries,
+		given as GeoJSON-like geometries in the CRS of the mask.
+
+		All geometries are rasterized at once into a coverage raster where pixel bit i is set when the pixel lies
+		within geometry i (32 geometries per coverage band). The mask is traversed once, in strips of strip_height
+		rows over the union window of the geometries, and the counts of all geometries come from one reduction over
+		the distinct coverage values of each strip.
+
+		Returns arrays with the number of valid and invalid pixels for each geometry.
+	"""
+	n = len(geometries)
+	valid_count = np.zeros(n, dtype=np.int64)
+	invalid_count = np.zeros(n, dtype=np.int64)
+
+	windows = [_footprintWindow(rasterio.features.bounds(geom), SIT_mask.transform, SIT_mask.shape)
+			   for geom in geometries]
+	inside = [i for i, window in enumerate(windows) if window is not None]
+	if len(inside) == 0:
+		return valid_count, invalid_count
+
+	col_off = min(windows[i].col_off for i in inside)
+	row_off = min(windows[i].row_off for i in inside)
+	col_end = max(windows[i].col_off + windows[i].width for i in inside)
+	row_end = max(windows[i].row_off + windows[i].height for i in inside)
+
+	# Geometries are split in chunks of 32, one bit per geometry in each uint32 coverage band
+	chunks = [inside[i:i + 32] for i in range(0, len(inside), 32)]
+	bits = np.arange(32, dtype=np.uint32)
+
+	for row in range(row_off, row_end, strip_height):
+		strip = Window(col_off, row, col_end - col_off, min(strip_height, row_end - row))
+		strip_transform = rasterio.windows.transform(strip, SIT_mask.transform)
+		valid, data = readSITMask(SIT_mask, strip)
+		invalid = data & ~valid
+
+		for chunk in chunks:
+			shapes = [(geometries[i], 1 << b) for b, i in enumerate(chunk)
+					  if windows[i].row_off < row + strip.height and windows[i].row_off + windows[i].height > row]
+			if len(shapes) == 0:
+				continue
+			coverage = rasterio.features.rasterize(shapes, out_shape=(strip.height, strip.width),
+												   transform=strip_transform, fill=0, dtype='uint32',
+												   merge_alg=MergeAlg.add)
+
+			for pixels, count in ((valid, valid_count), (invalid, invalid_count)):
+				codes, code_count = np.unique(coverage[pixels], return_counts=True)
+				member = (codes[:, None] >> bits[:len(chunk)]) & 1
+				count[chunk] += code_count @ member
+
+	return valid_count, invalid_count
+
+
+@instrumented()
+def searchSITPixels(SIT_mask, S2Odict, minSIT_pixels=2000, minSIT_percent=20):
 	kept_products = []
+	products = list(S2Odict.values())
 
-	# Using the raster mask to map the S2 footprints and calculate the amount of SIT pixels
-	# In each S2 product
-	with rasterio.open(pathSIT) as r:
+	# Using the mask to map the S2 footprints and calculate the amount of SIT pixels
+	# In each S2 product, all footprints are counted in one pass over the mask
+	# The footprints of all products are transformed in one call
+	footShapes = [shapely.wkt.loads(prod['footprint']) for prod in products]
+	geoms_S2_trans = transformGeometries('EPSG:4326', SIT_mask.crs, footShapes)
 
-		for prod in S2Odict.values():
-			footShape = shapely.wkt.loads(prod['footprint'])
-			foot = mapping(footShape)
-			geom_S2_trans = warp.transform_geom({'init': 'epsg:4326'}, r.crs, foot)
+	SIT_count, NO_SIT_count = countSITPixels(SIT_mask, geoms_S2_trans)
 
-			masked, out_trans = rasterio.mask.mask(r, [geom_S2_trans])
+	for prod, SIT_pix, NO_SIT in zip(products, SIT_count, NO_SIT_count):
+		perc_sit = (SIT_pix / (NO_SIT + SIT_pix)) * 100 if (NO_SIT + SIT_pix) > 0 else 0.0
+		print('Product ID: ', prod['identifier'])
+		print("Percentage of thin sea ice pixels are: {}%".format(np.round(perc_sit, 2)))
+		print("With {} valid pixels".format(SIT_pix))
+		if (perc_sit >= minSIT_percent) & (SIT_pix >= minSIT_pixels):
+			kept_products.append(prod)
+
+	return kept_products
 
-			SIT_pix = masked[0] == 100
-			NO_SIT = masked[0] == 0
 
-			perc_sit = (np.sum(SIT_pix) / (np.sum(NO_SIT) + np.sum(SIT_pix))) * 100
-			print('Product ID: ', prod['identifier'])
-			print("Percentage of thin sea ice pixels are: {}%".format(np.round(perc_sit, 2)))
-			print("With {} valid pixels".format(np.sum(SIT_pix)))
-			if (perc_sit >= minSIT_percent) & (np.sum(SIT_pix) >= minSIT_pixels):
-				kept_products.append(prod)
+def _queryCacheKey(footprint, date, cloudcover, producttype):
+	key = json.dumps([footprint, [str(d) for d in date], str(cloudcover), producttype])
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _evictQueryCache(cache_dir, max_size):
+	"""
+		Remove the least recently used query results until the cache is at most max_size bytes. The cache can be
+		shared by several workers, entries removed by another worker in the meantime are skipped.
+	"""
+	entries = []
+	for f in os.listdir(cache_dir):
+		if f.endswith('.pickle'):
+			try:
+				stat = os.stat(os.path.join(cache_dir, f))
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, f)))
+	entries.sort()
+	size = sum(entry[1] for entry in entries)
+	while entries and size > max_size:
+		mtime, entry_size, oldest = entries.pop(0)
+		size -= entry_size
+		try:
+			os.remove(oldest)
+		except FileNotFoundError:
+			pass
+
+
+@instrumented()
+def queryS2Products(api, footprint, date, cloudcover=(0, 30), producttype="S2MSI1C", cache_dir=None, ttl=86400,
+					max_size=100e6, offline=False):
+	"""
+		Query the hub for Sentinel-2 products, with an optional on-disk cache of the query results.
+
+		api: SentinelAPI, or any object with the same query method. Not used in offline mode and may be None
+		footprint: Footprint of the search area as WKT
+		date: Time interval (start, end) of the search
+		cloudcover: Cloud cover percentage (min, max)
+		producttype: Sentinel-2 product type
+		cache_dir: Directory of the cache, results are cached per (footprint, date, cloudcover, producttype), no
+			caching if None
+		ttl: Time in seconds a cached result is valid
+		max_size: Size in bytes of the cache, the least recently used results are evicted beyond it
+		offline: Only use the cache, cached results are used regardless of their age
+
+		Returns the query result, an ordered dictionary of product metadata keyed by product id
+	"""
+	if cache_dir is None:
+		if offline:
+			raise ValueError("Offline mode needs a query cache directory")
+		return api.query(footprint, date=date, platformname='Sentinel-2', cloudcoverpercentage=cloudcover,
+						 producttype=producttype)
+
+	os.makedirs(cache_dir, exist_ok=True)
+	cache_file = os.path.join(cache_dir, _queryCacheKey(footprint, date, cloudcover, producttype) + '.pickle')
+
+	# Another worker sharing the cache may evict the entry at any time
+	try:
+		with open(cache_file, 'rb') as src:
+			cached = pickle.load(src)
+	except FileNotFoundError:
+		cached = None
+	if cached is not None:
+		if offline or time.time() - cached['created'] <= ttl:
+			# Mark the entry as recently used for the eviction
+			try:
+				os.utime(cache_file, None)
+			except FileNotFoundError:
+				pass
+			print("Using cached query result from {}".format(time.ctime(cached['created'])))
+			return cached['products']
+	elif offline:
+		raise RuntimeError("No cached query result for this footprint and time interval, can not query the hub in "
+						   "offline mode")
+
+	products = api.query(footprint, date=date, platformname='Sentinel-2', cloudcoverpercentage=cloudcover,
+						 producttype=producttype)
+
+	# Workers writing the same entry each write their own temporary file
+	fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+	try:
+		with os.fdopen(fd, 'wb') as dst:
+			pickle.dump({'created': time.time(), 'products': products}, dst)
+		os.replace(tmp_file, cache_file)
+	except Exception:
+		os.remove(tmp_file)
+		raise
+	_evictQueryCache(cache_dir, max_size)
+
+	return products
+
+
+@instrumented()
+def findS2Products(path, api, validvals=(), validinterval=(0, 0), delta="hours=1", cloudcover=(0, 30),
+				   minS2pixels=2000, minS2pixelPerc=20, footprintMode='edges', footprintStep=100, cache_dir=None,
+				   cache_ttl=86400, cache_max_size=100e6, offline=False, archive=None):
+	"""
+		Find the Sentinel-2 level 1C products overlapping the valid pixels of a mask, the library version of running
+		the script. The api session can be shared between calls, for instance by a batch over many masks.
+
+		path: Path to mask raster, the name starts with the sensing time of the mask (YYYYMMDD_HHMM...)
+		api: SentinelAPI session, may be None in offline mode or with an archive
+		archive: Local archive the products are selected from instead of querying the hub, a directory of products
+			or an ArchiveIndex from S2_archive.buildArchiveIndex, which can be shared between calls. The cloud cover
+			is not filtered, and the products have a 'path' to the product in the archive
+		See the script arguments for the other parameters, cache_ttl is in seconds and cache_max_size in bytes
+
+		Returns kept_products, the metadata of the products with enough valid pixels
+	"""
+	if (len(validvals) == 0) and (sum(validinterval)==0):
+		raise ValueError("Need input for either --ValidInterval or --ValidValues")
+
+	print("Creating Footprint...")
+	lonlat, geom = createFootprint(path, saveasGeojson=False, mode=footprintMode, step=footprintStep)
+	print("Footprint created for {}".format(os.path.basename(path)))
+	starttime, endtime = deltaTimeSIT(path, delta)
+
+	print("Searching for Sentinel-2 level 1 products within specified time...")
+	if archive is not None:
+		if isinstance(archive, str):
+			archive = buildArchiveIndex(archive, '*MSIL1C*')
+		S2products1C = queryArchive(archive, geom["features"][0]["geometry"], date=(starttime, endtime))
+	else:
+		S2products1C = queryS2Products(api, geojson_to_wkt(geom),
+									   date = (starttime,endtime),
+									   cloudcover = cloudcover,
+									   producttype="S2MSI1C",
+									   cache_dir=cache_dir, ttl=cache_ttl, max_size=cache_max_size, offline=offline)
+
+	SIT_mask = createSITMask(path, validvals=validvals, validinterval=validinterval)
+
+	kept_products = searchSITPixels(SIT_mask, S2products1C, minSIT_pixels=minS2pixels,
+									minSIT_percent=minS2pixelPerc)
 
 	return kept_products
 
@@ -190,28 +508,97 @@ def parseUserPass(txtPath):
 		username, password = userpass.split(', ')
 	return (username, password)
 
-print("Creating Footprint...")
-lonlat, geom = createFootprint(path, saveasGeojson=False)
-print("Footprint created for {}".format(os.path.basename(path)))
-starttime, endtime = deltaTimeSIT(path, delta)
-
-#Username and password from https://scihub.copernicus.eu/dhus
-
-user, password = parseUserPass(txtpath)
-
-Sentinel2api = SentinelAPI(user, password)
-
-print("Searching for Sentinel-2 level 1 products within specified time...")
-S2products1C = Sentinel2api.query(geojson_to_wkt(geom),
-							  date = (starttime,endtime),
-							  platformname = 'Sentinel-2',
-							  cloudcoverpercentage = cloudcover,
-							  producttype="S2MSI1C")
-
-name = 'SIT_pixels'
-createSITMask(path, name=name)
-
-kept_products = searchSITPixels(name + '.tif', S2products1C, minSIT_pixels=minS2pixels, 
-								minSIT_percent=minS2pixelPerc)
-os.remove(name+'.tif')
-
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	optional = parser._action_groups.pop()
+	required = parser.add_argument_group("required arguments")
+
+	required.add_argument("--MaskPath", help="Path to mask product", required=True)
+	required.add_argument("--ValidInterval", nargs="+",type=int, default=[0,0], help="Interval of values from mask")
+	required.add_argument("--ValidValues",'--list', nargs='+',type=int,default=[], help='Valid values for mask')
+	required.add_argument("--cloudcover",default=(0,30), help="Cloud cover percentage (min, max)")
+	required.add_argument("--delta", default="hours=1", help="Time difference from SIT product")
+	required.add_argument("--credentials", help="Path to .txt file specifying username and password for copernicus.com, "
+												"required unless --offline or --archive")
+	required.add_argument("--minS2pixels", default=2000, type=int, 
+						  help="Minimum amount of valid pixels in S2 product,default=2000")
+	required.add_argument("--minS2pixelPerc", default=20, type=int, 
+						  help="Minimum percentage of valid pixels in S2 product, default=20")
+	required.add_argument("--FootprintMode", default="edges", choices=["edges", "outline", "full"],
+						  help="Footprint from the raster edges, the valid data outline or every pixel, default=edges")
+	required.add_argument("--FootprintStep", default=100, type=int,
+						  help="Distance in pixels between footprint vertices, default=100")
+	required.add_argument("--cache_dir", default=None, help="Directory of the query cache, default=None (no cache)")
+	required.add_argument("--cache_ttl", default=24, type=float,
+						  help="Hours a cached query result is valid, default=24")
+	required.add_argument("--cache_max_size", default=100, type=float,
+						  help="Size of the query cache in MB, default=100")
+	required.add_argument("--offline", action="store_true",
+						  help="Only use cached query results, never connect to the hub")
+	required.add_argument("--download", default=None,
+						  help="Directory the overlapping products are downloaded to, default=None (no download)")
+	required.add_argument("--download_workers", default=2, type=int,
+						  help="Number of products downloaded at the same time, default=2")
+	required.add_argument("--unzip", action="store_true", help="Extract the downloaded products to .SAFE directories")
+	required.add_argument("--archive", default=None,
+						  help="Directory of S2 products the overlapping products are selected from, instead of "
+							   "querying the hub, default=None")
+	required.add_argument("--profile_out", default=None,
+						  help="Write the time, memory and I/O of each processing stage to this .json or .csv file, "
+							   "default=None")
+					  
+	args = parser.parse_args()
+	cloudcover = args.cloudcover
+	path = args.MaskPath
+	txtpath = args.credentials
+	delta = args.delta
+	validvals = args.ValidValues
+	validinterval = args.ValidInterval
+	minS2pixels=args.minS2pixels
+	minS2pixelPerc = args.minS2pixelPerc
+	footprintMode = args.FootprintMode
+	footprintStep = args.FootprintStep
+	cache_dir = args.cache_dir
+	cache_ttl = args.cache_ttl * 3600
+	cache_max_size = args.cache_max_size * 1e6
+	offline = args.offline
+	download_dir = args.download
+	download_workers = args.download_workers
+	unzip = args.unzip
+	archive = args.archive
+	profile_out = args.profile_out
+
+	if profile_out is not None:
+		Instrumentation.enable()
+
+	if (txtpath is None) and not offline and (archive is None):
+		raise ValueError("Need input for --credentials, unless running --offline or with --archive")
+	if (offline or (archive is not None)) and (download_dir is not None):
+		raise ValueError("Can not --download when running --offline or with --archive")
+
+	#Username and password from https://scihub.copernicus.eu/dhus
+
+	if offline or (archive is not None):
+		Sentinel2api = None
+	else:
+		user, password = parseUserPass(txtpath)
+
+		Sentinel2api = SentinelAPI(user, password)
+
+	kept_products = findS2Products(path, Sentinel2api, validvals=validvals, validinterval=validinterval, delta=delta,
+								   cloudcover=cloudcover, minS2pixels=minS2pixels, minS2pixelPerc=minS2pixelPerc,
+								   footprintMode=footprintMode, footprintStep=footprintStep, cache_dir=cache_dir,
+								   cache_ttl=cache_ttl, cache_max_size=cache_max_size, offline=offline,
+								   archive=archive)
+
+	if download_dir is not None:
+		print("Downloading {} products to {}...".format(len(kept_products), download_dir))
+		downloaded = downloadProducts(kept_products, download_dir, api=Sentinel2api, workers=download_workers,
+									  unzip=unzip)
+		failed = sum(1 for prod in downloaded.values() if prod is None)
+		if failed:
+			print("{} of {} products failed to download or are offline, run the script again to retry".format(
+				failed, len(downloaded)))
+
+	if profile_out is not None:
+		print("Processing profile written to: {}".format(Instrumentation.exportRecords(profile_out)))
@@ -3,59 +3,135 @@ import os
 from glob import glob
 from rasterio.warp import Resampling
 import rasterio.warp as warp
+from rasterio.io import MemoryFile
+import numpy as np
+from Instrumentation import instrumented
+from S2_Reproject_Merge import bandGroups, finalizeOutput, outputProfile, targetWindow, windowProfile
 
 
-def Acolite_reproject_stack_bands(srcPath, s2path, destBands, destination):
+def _rhosBands(s2path):
     """
-    Reproject the ACOLITE output to fit to a overlapping raster
-
-    :param srcPath: the overlapping raster
-    :param s2path: path to the ACOLITE output
-    :param destBands: destination for the reprojected bands
-    :param destination: destination for the final stacked output raster
-    :return: None
+    The rhos_* band files of an ACOLITE output, in the same order for S2A and S2B
     """
     if os.path.basename(glob(os.path.join(s2path,'S2*'))[0])[:3]=='S2B':
         bands = ['442', '492', '559', '665', '704', '739', '780', '833', '864', '1610', '2186', ]
     else:
         bands = ['443', '492', '560', '665', '704', '740', '783', '833', '865', '1614', '2202']
 
-    band_list = []
-    if not os.path.exists(destBands):
-        os.mkdir(destBands)
+    return [glob(os.path.join(s2path, '*rhos_' + band + '.tif'))[0] for band in bands]
+
+
+def _validPixels(data, nodata):
+    """
+    Pixels of data that are not NaN or nodata
+    """
+    valid = ~np.isnan(data)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= data != nodata
+    return valid
+
+
+@instrumented()
+def Acolite_reproject_stack_bands(srcPath, s2path, destination, *, tiled=False, compress=None, blocksize=256,
+                                  max_z_error=0, overviews=False, cog=False, window_warp=False):
+    """
+    Reproject the ACOLITE output to fit to a overlapping raster, each band is reprojected directly into the bands of
+    the stacked output raster.
+    Several ACOLITE outputs, e.g. of the groups of Acolite_AC_process.process_acolite, are composited in the order
+    they are given, keeping the first valid value of each pixel.
+
+    :param srcPath: the overlapping raster
+    :param s2path: path to the ACOLITE output, or a list of paths to ACOLITE outputs
+    :param destination: destination for the final stacked output raster. The options after it are keyword-only, so
+        old calls still passing destBands before destination fail instead of writing to destBands
+    :param tiled: write the output with internal tiling
+    :param compress: compression of the output, e.g. 'deflate', 'zstd' or 'lerc'
+    :param blocksize: width and height of the blocks of a tiled output
+    :param max_z_error: maximum error of LERC compression
+    :param overviews: build internal overviews in the output
+    :param cog: write the output as a Cloud Optimized GeoTIFF, with overviews
+    :param window_warp: warp each ACOLITE output into the window of the output overlapping it only, faster but not
+        identical to warping into the whole grid, see S2_Reproject_Merge.targetWindow
+    :return: None
+    """
+    s2paths = [s2path] if isinstance(s2path, str) else list(s2path)
+    band_lists = [_rhosBands(path) for path in s2paths]
+
     with rasterio.open(srcPath) as src:
         kwargs = src.profile
-        for band in bands:
-            rhos_ = glob(os.path.join(s2path, '*rhos_' + band + '.tif'))[0]
-            base_rhos_ = os.path.basename(rhos_)[0:-4]
-            dest_rhos_ = os.path.join(destBands, base_rhos_ + 'reproject.tif')
-            band_list.append(dest_rhos_)
-            print("reprojecting: {}".format(base_rhos_))
-            with rasterio.open(rhos_) as s2:
-                kwargs.update({'nodata': s2.profile['nodata'],
-                               'driver': 'GTiff',
-                               'dtype': s2.profile['dtype']
-                               })
-                with rasterio.open(dest_rhos_, 'w', **kwargs) as s2dst:
-                    warp.reproject(
-                        rasterio.band(s2, 1),
-                        rasterio.band(s2dst, 1),
-                        resampling=Resampling.average
-                    )
-        print("Stacking layers to: {}".format(destination))
-        with rasterio.open(band_list[1]) as src0:
-            kwargs = src0.profile
-            kwargs.update({'count': len(band_list),
-                           'nodata': src0.profile['nodata']})
-        with rasterio.open(destination, 'w', **kwargs) as dst:
-            for id, layer in enumerate(band_list, start=1):
-                with rasterio.open(layer) as src1:
-                    dst.write_band(id, src1.read(1))
-
-srcPath = r"C:\Users\oyste\OneDrive\Shared\UiT skole\MastersFolder\raster_code\sentinel4thinice_navgem_500\navgem\500\20190311_103537_103837_slstr_tti-color_500.tif"
-path = r"E:\MastersProjectData\SIT_S2\20190311_103537_103837_slstr_tti-color_500"
-s2path = os.path.join(path, 'merged_ACOLITE')
-destination = os.path.join(s2path, 'merged.tif')
-destBands = os.path.join(s2path, 'reproject_bands')
-
-Acolite_reproject_stack_bands(srcPath, s2path, destBands, destination)
+    with rasterio.open(band_lists[0][0]) as s2:
+        kwargs.update({'count': len(band_lists[0]),
+                       'nodata': s2.profile['nodata'],
+                       'driver': 'GTiff',
+                       'dtype': s2.profile['dtype']
+                       })
+        kwargs = outputProfile(kwargs, tiled=tiled, compress=compress, blocksize=blocksize, max_z_error=max_z_error)
+
+    # Pixels the warp does not reach are NaN when the rhos_* files have no nodata value, so they are not taken for data
+    warp_nodata = kwargs['nodata'] if kwargs['nodata'] is not None else np.nan
+    # Pixels of each band already written by an ACOLITE output, the output itself can not tell them apart from
+    # unwritten pixels when it has no nodata value
+    filled = {}
+
+    print("Reprojecting and stacking layers to: {}".format(destination))
+    with rasterio.open(destination, 'w+', **kwargs) as dst:
+        for s2path, band_list in zip(s2paths, band_lists):
+            with rasterio.open(band_list[0]) as s2:
+                window = targetWindow(s2.bounds, s2.crs, kwargs, crop=window_warp)
+            if window is None:
+                print("ACOLITE output {} does not overlap {}".format(s2path, srcPath))
+                continue
+
+            kwargsBand = windowProfile(kwargs, window)
+            kwargsBand['nodata'] = warp_nodata
+            for option in ('compress', 'predictor', 'max_z_error'):
+                kwargsBand.pop(option, None)
+            region = (slice(window.row_off, window.row_off + window.height),
+                      slice(window.col_off, window.col_off + window.width))
+            # The bands on the same grid are warped in one multi-band call, sharing the coordinate transformation
+            for group in bandGroups(band_list):
+                indexes = [id for id, rhos_ in group]
+                for id, rhos_ in group:
+                    print("reprojecting: {}".format(os.path.basename(rhos_)[0:-4]))
+                # The bands are read straight into one array, not stacked from copies
+                data = None
+                for i, (id, rhos_) in enumerate(group):
+                    with rasterio.open(rhos_) as s2:
+                        if data is None:
+                            data = np.empty((len(group),) + s2.shape, dtype=kwargs['dtype'])
+                            src_transform, src_crs, src_nodata = s2.transform, s2.crs, s2.nodata
+                        s2.read(1, out=data[i])
+                kwargsBand.update({'count': len(group)})
+                with MemoryFile() as memfile:
+                    with memfile.open(**kwargsBand) as mem:
+                        warp.reproject(
+                            data,
+                            rasterio.band(mem, list(range(1, len(group) + 1))),
+                            src_transform=src_transform,
+                            src_crs=src_crs,
+                            src_nodata=src_nodata,
+                            dst_nodata=warp_nodata,
+                            resampling=Resampling.average
+                        )
+                        reprojected = mem.read()
+
+                # Keep the values of the outputs composited before
+                merged = dst.read(indexes, window=window)
+                for i, id in enumerate(indexes):
+                    if id not in filled:
+                        filled[id] = np.zeros((kwargs['height'], kwargs['width']), dtype=bool)
+                    valid = _validPixels(reprojected[i], warp_nodata)
+                    update = valid & ~filled[id][region]
+                    merged[i][update] = reprojected[i][update]
+                    filled[id][region] |= valid
+                dst.write(merged, indexes, window=window)
+
+    finalizeOutput(destination, overviews=overviews, cog=cog, max_z_error=max_z_error)
+
+if __name__ == "__main__":
+    srcPath = r"C:\Users\oyste\OneDrive\Shared\UiT skole\MastersFolder\raster_code\sentinel4thinice_navgem_500\navgem\500\20190311_103537_103837_slstr_tti-color_500.tif"
+    path = r"E:\MastersProjectData\SIT_S2\20190311_103537_103837_slstr_tti-color_500"
+    s2path = os.path.join(path, 'merged_ACOLITE')
+    destination = os.path.join(s2path, 'merged.tif')
+
+    Acolite_reproject_stack_bands(srcPath, s2path, destination)
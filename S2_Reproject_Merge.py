@@ -1,60 +1,36 @@
 import rasterio
 from glob import glob
 import rasterio.warp as warp
-from rasterio.merge import merge
 from rasterio.warp import Resampling
 import rasterio.mask
 import argparse
 import os
-
-parser = argparse.ArgumentParser(description=__doc__)
-optional = parser._action_groups.pop()
-required = parser.add_argument_group("required arguments")
-
-required.add_argument("--ProcessingLevel", help="Specify S2 processing level, default=L1C", default="L1C")
-required.add_argument("--SrcPath", help="Path to src product corresponding to the S2 products",
-					  required=True)
-required.add_argument("--S2Source", help="Path to S2 products source folder", required=True)
-required.add_argument("--destination", help="Path to destination of reprojected and merged products",
-					  required=True)
-
-required.add_argument('--bands', '--names-list', nargs='+', default=['all'], 
-					  help="Define bands you want to keep, default=all")
-required.add_argument('--resampling', default="nearest",help="Resampling method to use from rasterio.warp.Resampling, default=nearest")
-
-
-args = parser.parse_args()
-S2path =args.S2Source
-SITPath = args.SrcPath
-dest = args.destination
-bandsarg = args.bands
-resampling_arg = args.resampling
-processing_level = args.ProcessingLevel
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from collections import deque
+import hashlib
+import json
+from itertools import chain, tee
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+import rasterio.windows
+import rasterio.shutil
+from affine import Affine
+import numpy as np
+from S2_safe import globProduct, listProducts, productName
+from S2_archive import selectArchiveProducts
+from Mask_S2_Overlap import deltaTimeSIT
+import Instrumentation
+from Instrumentation import instrumented
 
 
 all_bands_1C = ['B01', 'B02','B03','B04','B05','B06','B07','B08','B8A','B09','B10','B11', 'B12']
 all_bands_2A = ['B01', 'B02','B03','B04','B05','B06','B07','B8A','B09','B11', 'B12']
 
-if processing_level == "L1C":
-	if bandsarg[0] == 'all':
-
-		bands_name = all_bands_1C
-	else:
-		checkbands = [i for i in bandsarg if i in all_bands_1C]
-		if len(checkbands)==0:
-			raise ValueError("--bands must contain at least one of these elements: B01, B02, B03, B04', B05, B06, B07, B08, B8A, B09, B10, B11, B12")
-		bands_name = bandsarg
-elif processing_level == "L2A":
-	if bandsarg[0] == 'all':
+# Reflectance = DN / quantification_value, kept as integer DN with a scale in the metadata for the integer dtypes
+quantification_value = 10000
+output_dtypes = ('float32', 'uint16', 'int16')
 
-		bands_name = all_bands_2A
-	else:
-		checkbands = [i for i in bandsarg if i in all_bands_2A]
-		if len(checkbands)==0:
-			raise ValueError("--bands must contain at least one of these elements: B01, B02, B03, B04, B05, B06, B07, B8A, B09, B11, B12")
-		bands_name = bandsarg
-else:
-	raise ValueError("--ProcessingLevel must either be L1C or L2A")
 
 def resampling_method(method):
 	if method == 'nearest':
@@ -85,157 +61,922 @@ def resampling_method(method):
 		raise ValueError("Invalid method, does not exist, check rasterio.warp.Resampling for reference.")
 		return None
 
-def ReprojectS2Products(srcPath, S2Dir, destinationDir, procLevel):
+def outputProfile(kwargs, tiled=False, compress=None, blocksize=256, max_z_error=0):
+	"""
+		Copy of the raster profile kwargs with optional internal tiling (blocksize x blocksize blocks) and compression
+		(e.g. 'deflate', 'lzw', 'zstd' or 'lerc'). DEFLATE, LZW and ZSTD get the floating point predictor for float
+		rasters and horizontal differencing otherwise, so the dtype in kwargs must be the one written. LERC is
+		lossless unless max_z_error > 0.
+	"""
+	kwargs = kwargs.copy()
+	if tiled:
+		kwargs.update({'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize})
+	if compress is not None:
+		compress = compress.lower()
+		kwargs.update({'compress': compress})
+		if compress in ('deflate', 'lzw', 'zstd'):
+			kwargs.update({'predictor': 3 if np.issubdtype(np.dtype(kwargs['dtype']), np.floating) else 2})
+		elif compress.startswith('lerc'):
+			kwargs.update({'max_z_error': max_z_error})
+	return kwargs
+
+
+@instrumented()
+def finalizeOutput(path, overviews=False, cog=False, resampling='average', max_z_error=0):
+	"""
+		Add internal overviews to a written raster, or rewrite it as a Cloud Optimized GeoTIFF with overviews, keeping
+		its compression. Overviews are built by factors of 2 down to the size of one 256 pixel block.
+
+		path: Path to the raster
+		overviews: Build internal overviews in place
+		cog: Rewrite the raster as a COG (tiled, overviews first), with GDAL's COG driver
+		resampling: Resampling method of the overviews, see resampling_method
+		max_z_error: Maximum error of LERC compression in the COG
+	"""
+	if cog:
+		with rasterio.open(path) as src:
+			profile = src.profile
+			floating = np.issubdtype(np.dtype(src.dtypes[0]), np.floating)
+		options = {'BLOCKSIZE': profile['blockxsize'] if profile.get('tiled') else 512,
+				   'OVERVIEWS': 'AUTO', 'OVERVIEW_RESAMPLING': resampling_method(resampling).name.upper()}
+		compress = profile.get('compress')
+		if compress is not None:
+			options['COMPRESS'] = compress.upper()
+			if compress.lower() in ('deflate', 'lzw', 'zstd'):
+				options['PREDICTOR'] = 'FLOATING_POINT' if floating else 'YES'
+			elif compress.lower().startswith('lerc'):
+				options['MAX_Z_ERROR'] = max_z_error
+		tmp = path + '.cog.tif'
+		rasterio.shutil.copy(path, tmp, driver='COG', **options)
+		os.replace(tmp, path)
+	elif overviews:
+		with rasterio.open(path, 'r+') as dst:
+			factors = []
+			while max(dst.width, dst.height) // 2 ** (len(factors) + 1) >= 256:
+				factors.append(2 ** (len(factors) + 1))
+			if factors:
+				dst.build_overviews(factors, resampling_method(resampling))
+				dst.update_tags(ns='rio_overview', resampling=resampling)
+
+
+def targetWindow(src_bounds, src_crs, kwargs, crop=True):
 	"""
-		Function that reprojects and stacks each band of several S2 products to source raster. S2 products and source raster
-		must overlap.
+		Window of the grid in the raster profile kwargs covering src_bounds (in src_crs), expanded to whole blocks of
+		the grid, or the whole grid if not crop. Returns None if the bounds do not overlap the grid.
+
+		A warp into the cropped window is not identical to a warp into the whole grid, also with an exact transformer.
+		GDAL derives the source window and the scale of the resampling kernel of each warp chunk from the size of the
+		destination. On synthetic products warped onto a 500 m grid, nearest changes about 1 % of the valid pixels
+		and bilinear nearly all of them, by up to the full range of the values.
+	"""
+	left, bottom, right, top = warp.transform_bounds(src_crs, kwargs['crs'], *src_bounds, densify_pts=21)
+	window = rasterio.windows.from_bounds(left, bottom, right, top, kwargs['transform'])
+
+	if kwargs.get('tiled'):
+		blockysize, blockxsize = kwargs['blockysize'], kwargs['blockxsize']
+	else:
+		# Strips span the whole width
+		blockysize, blockxsize = kwargs.get('blockysize', 1), kwargs['width']
+
+	col_start = max(int(np.floor(window.col_off)) // blockxsize * blockxsize, 0)
+	row_start = max(int(np.floor(window.row_off)) // blockysize * blockysize, 0)
+	col_stop = min(-(-int(np.ceil(window.col_off + window.width)) // blockxsize) * blockxsize, kwargs['width'])
+	row_stop = min(-(-int(np.ceil(window.row_off + window.height)) // blockysize) * blockysize, kwargs['height'])
+	if col_start >= col_stop or row_start >= row_stop:
+		return None
+	if not crop:
+		return Window(0, 0, kwargs['width'], kwargs['height'])
+
+	return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def windowProfile(kwargs, window):
+	"""
+		Copy of the raster profile kwargs cropped to window
+	"""
+	kwargs = kwargs.copy()
+	kwargs.update({'width': window.width,
+				   'height': window.height,
+				   'transform': rasterio.windows.transform(window, kwargs['transform'])})
+	return kwargs
+
+
+# Resampling methods a decimated read can use before the warp, see _decimationFactor
+decimated_reads = {'nearest': Resampling.nearest, 'mode': Resampling.mode, 'average': Resampling.average,
+				   'bilinear': Resampling.average, 'cubic': Resampling.average,
+				   'cubic_spline': Resampling.average, 'lanczos': Resampling.average}
+
+
+def _decimationFactor(band, kwargs, resampling):
+	"""
+		Power of 2 factor a band can be decimated by before it is warped to the grid in kwargs, 1 for no decimation.
+
+		Nearest and mode keep at least one source pixel per target pixel, the interpolating methods at least two,
+		read as the average of the decimated pixels. max, min, med, q1 and q3 are never decimated. Powers of 2
+		match the resolution levels of JPEG2000, so GDAL decodes the bands at the reduced resolution directly.
+	"""
+	if resampling not in decimated_reads:
+		return 1
+
+	# Target pixel size in the CRS of the band, from the pixel sides at the centre of the grid
+	T = kwargs['transform']
+	cols = np.array([0, 1, 0]) + kwargs['width'] / 2
+	rows = np.array([0, 0, 1]) + kwargs['height'] / 2
+	xs, ys = warp.transform(kwargs['crs'], band.crs, T.c + cols * T.a + rows * T.b, T.f + cols * T.d + rows * T.e)
+	size = min(np.hypot(xs[1] - xs[0], ys[1] - ys[0]), np.hypot(xs[2] - xs[0], ys[2] - ys[0]))
+	ratio = size / max(band.res)
+	if resampling not in ('nearest', 'mode'):
+		ratio /= 2
+
+	factor = 1
+	while factor * 2 <= ratio and band.width // (factor * 2) > 0 and band.height // (factor * 2) > 0:
+		factor *= 2
+	return factor
+
+
+def _readShape(band, kwargs, resampling, decimate=False):
+	"""
+		Shape a S2 band is read at, decimated to about the pixel size of the grid in kwargs if decimate.
+		Returns the shape and the transform of the band read at that shape
+	"""
+	factor = _decimationFactor(band, kwargs, resampling) if decimate else 1
+	if factor == 1:
+		return band.shape, band.transform
+
+	out_shape = (int(np.ceil(band.height / factor)), int(np.ceil(band.width / factor)))
+	transform = band.transform * Affine.scale(band.width / out_shape[1], band.height / out_shape[0])
+	return out_shape, transform
 
-		srcPath: Path to source raster.
-		S2Dir: Path to directory of S2 products in .SAFE format
-		destinationDir: Path to destination directory where the resulting rasters will be stored
 
+def _readBand(band, out, resampling):
+	"""
+		Read a S2 band into the array out, at the shape of out, see _readShape. GDAL converts the DN to the dtype of
+		out, saturating at the range of integer dtypes
+	"""
+	band.read(1, out=out, resampling=decimated_reads.get(resampling, Resampling.nearest))
+
+
+def bandGroups(file_list):
+	"""
+		Group the band files of a product by grid (CRS, transform, shape) and nodata value, e.g. the 10, 20 and 60 m
+		bands of a L1C product. Returns a list of groups, each a list of (band index from 1, band file)
+	"""
+	groups = {}
+	for id, bfp in enumerate(file_list, start=1):
+		with rasterio.open(bfp) as band:
+			key = (band.crs.to_wkt(), band.transform, band.shape, band.nodata)
+		groups.setdefault(key, []).append((id, bfp))
+	return list(groups.values())
+
+
+def _toOutputType(data):
+	"""
+		Convert S2 DN read into an array of the output dtype in place, to TOA reflectance for float32. The integer
+		dtypes keep the DN, clipped to their range by the read
+	"""
+	if np.issubdtype(data.dtype, np.floating):
+		data /= quantification_value
+	return data
+
+
+def _writeScaling(dst):
+	"""
+		Record reflectance = DN * scale + offset in the metadata of a raster with integer DN bands
+	"""
+	if np.issubdtype(np.dtype(dst.dtypes[0]), np.integer):
+		dst.scales = (1 / quantification_value,) * dst.count
+		dst.offsets = (0.0,) * dst.count
+
+
+def _reprojectBands(bfps, kwargs, resampling, num_threads=1, decimate=False):
+	"""
+		Convert S2 bands on the same grid to the dtype of kwargs in memory, see _toOutputType, and reproject them to
+		the grid in kwargs in one multi-band warp, run by the worker pool. The coordinate transformation is computed
+		once for all the bands. With decimate, the bands are read at a resolution close to the grid, see
+		_decimationFactor. Returns the reprojected bands as a (bands, rows, cols) array.
+	"""
+	if kwargs['dtype'] not in output_dtypes:
+		raise ValueError("Invalid output dtype, choose one of these instead: {}".format(output_dtypes))
+	names = ','.join(os.path.basename(bfp) for bfp in bfps)
+	# The bands are read straight into one array of the output dtype and scaled in place, a group is held in memory
+	# once and not once per conversion
+	with Instrumentation.stage('readBands', bands=names):
+		for i, bfp in enumerate(bfps):
+			with rasterio.open(bfp) as band:
+				if i == 0:
+					shape, transform = _readShape(band, kwargs, resampling, decimate)
+					bandsTOA = np.empty((len(bfps),) + tuple(shape), dtype=kwargs['dtype'])
+					crs, nodata = band.crs, band.nodata
+				_readBand(band, bandsTOA[i], resampling)
+	with Instrumentation.stage('scaleBands', bands=names):
+		_toOutputType(bandsTOA)
+
+	kwargsBand = kwargs.copy()
+	for option in ('compress', 'predictor', 'max_z_error'):
+		kwargsBand.pop(option, None)
+	kwargsBand.update({'count': len(bfps), 'nodata': nodata})
+
+	# GDAL chunks the warp by the blocks of the destination, warping into an in-memory raster with the block
+	# layout of the output gives the same result as warping into the output itself
+	with MemoryFile() as memfile, Instrumentation.stage('warpBands', bands=names):
+		with memfile.open(**kwargsBand) as mem:
+			warp.reproject(
+				bandsTOA,
+				rasterio.band(mem, list(range(1, len(bfps) + 1))),
+				src_transform=transform,
+				src_crs=crs,
+				src_nodata=nodata,
+				resampling=resampling_method(resampling),
+				num_threads=num_threads)
+			return mem.read()
+
+
+def _reprojectStackBands(bfps, indexes, dst, lock, kwargs, resampling, num_threads=1, decimate=False):
+	"""
+		Reproject S2 bands on the same grid and write them to the band indexes of the stacked output dst, run by the
+		worker pool. Writes to dst are serialized by lock.
+	"""
+	reprojected = _reprojectBands(bfps, kwargs, resampling, num_threads, decimate)
+
+	with lock, Instrumentation.stage('writeBands', bands=','.join(os.path.basename(bfp) for bfp in bfps)):
+		dst.write(reprojected, indexes)
+
+
+def _productBands(prod, procLevel, bands_name):
+	"""
+		Name of a S2 product in .SAFE format, extracted or zipped, and the band files of the product. The band files
+		of a zipped product are /vsizip/ paths, read directly from the zip
+	"""
+	prod_name = productName(prod)
+
+	if procLevel == "L1C":
+		imgPath = globProduct(prod, 'GRANULE/L*/IMG_DATA', relative=True)[0]
+	else:
+		imgPath = globProduct(prod, 'GRANULE/L*/IMG_DATA/R*', relative=True)[0]
+
+	return prod_name, [globProduct(prod, imgPath + '/*'+band_+'*')[0] for band_ in bands_name]
+
+
+def _listProductBands(S2Dir, procLevel, bands_name=None):
+	"""
+		List the S2 products in S2Dir, extracted (.SAFE) or zipped (.zip), and the band files of each product. S2Dir
+		can also be an iterable of product paths, such as products taken from a queue as they are downloaded, which is
+		consumed lazily.
 
+		Returns an iterator of (product name, list of band files) and the length of the band file extension
 	"""
 	# List of all S2 products paths
 	if procLevel == "L1C":
 		band_name_base = 4
-		S2Products = glob(os.path.join(S2Dir, '*MSIL1C*'))
+		pattern = '*MSIL1C*'
+		if bands_name is None:
+			bands_name = all_bands_1C
 	else:
 		band_name_base = 8
-		S2Products = glob(os.path.join(S2Dir, '*MSIL2A*'))
-	
-	#print(S2Products)
+		pattern = '*MSIL2A*'
+		if bands_name is None:
+			bands_name = all_bands_2A
+
+	if isinstance(S2Dir, str):
+		S2Products = listProducts(S2Dir, pattern)
+	else:
+		S2Products = S2Dir
+
+	products = (_productBands(prod, procLevel, bands_name) for prod in S2Products)
+
+	return products, band_name_base
+
+
+def _printBand(bfp, band_name_base):
+	base = os.path.basename(bfp)
+	base = base[:len(base) - band_name_base]
+	print("        Band {}".format(base[-3:]))
+
+
+manifest_name = 'manifest.json'
+
+
+def _fileHash(path, chunk_size=2 ** 20):
+	"""
+		SHA-1 of the content of a file
+	"""
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as src:
+		for chunk in iter(lambda: src.read(chunk_size), b''):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+def _fileStat(path):
+	"""
+		Path, size and modification time of a file, of the zip for a /vsizip/ path
+	"""
+	if path.startswith('/vsizip/'):
+		path = path[len('/vsizip/'):path.lower().index('.zip') + 4]
+	stat = os.stat(path)
+	return [path, stat.st_size, stat.st_mtime]
+
+
+def _readManifest(destinationDir):
+	"""
+		Processing manifest of a destination directory of ReprojectS2Products, empty if there is none
+	"""
+	path = os.path.join(destinationDir, manifest_name)
+	if not os.path.exists(path):
+		return {}
+	with open(path) as src:
+		return json.load(src).get('products', {})
+
+
+def _writeManifest(destinationDir, products):
+	"""
+		Write the processing manifest atomically, a crash never leaves a partial manifest
+	"""
+	path = os.path.join(destinationDir, manifest_name)
+	with open(path + '.tmp', 'w') as dst:
+		json.dump({'version': 1, 'products': products}, dst, indent=1)
+	os.replace(path + '.tmp', path)
+
+
+@instrumented()
+def ReprojectS2Products(srcPath, S2Dir, destinationDir, procLevel, bands_name=None, resampling='nearest', workers=1,
+						num_threads=1, tiled=False, compress=None, decimate=False, blocksize=256, max_z_error=0,
+						dtype='float32', window_warp=False):
+	"""
+		Function that reprojects and stacks each band of several S2 products to source raster. The bands are reprojected
+		directly into the bands of one stacked raster per product. Products not overlapping the source raster are
+		skipped.
+
+		srcPath: Path to source raster.
+		S2Dir: Path to directory of S2 products in .SAFE format, extracted or zipped, or an iterable of product paths
+			consumed as the products become available, e.g. S2_download.iterQueue of a download queue
+		destinationDir: Path to destination directory where the resulting rasters will be stored
+		procLevel: S2 processing level, L1C or L2A
+		bands_name: Bands to reproject, default is all bands of the processing level
+		resampling: Resampling method, see resampling_method
+		workers: Number of band groups (bands of the same resolution), across all products, reprojected at the same
+			time
+		num_threads: Number of GDAL warp threads used for each band group
+		tiled: Write the stacked rasters with internal tiling
+		compress: Compression of the stacked rasters, e.g. 'deflate', 'zstd' or 'lerc', see outputProfile
+		decimate: Read the bands at a reduced resolution close to the pixel size of the source raster, see
+			_decimationFactor. Much faster for coarse source rasters, but not identical to warping the full bands
+		blocksize: Width and height of the blocks of tiled rasters
+		max_z_error: Maximum error of LERC compression
+		dtype: 'float32' for TOA reflectance, or 'uint16' or 'int16' to keep the DN, with reflectance = DN * scale +
+			offset in the band metadata. The integer dtypes halve the size of the rasters
+		window_warp: Warp each product into the window of the source raster grid overlapping it only, and write the
+			stacked raster cropped to that window. Much faster for products small against the source raster, but not
+			identical to warping into the whole grid, see targetWindow
+
+		The finished products are recorded in manifest.json in destinationDir, with the source raster hash, the
+		processing parameters and the size and modification time of the band files. When run again on the same
+		destinationDir, products with an unchanged record and stacked raster are skipped, and the stacked rasters of
+		products no longer listed are removed, so an interrupted run resumes where it stopped.
+	"""
+	S2Products, band_name_base = _listProductBands(S2Dir, procLevel, bands_name)
+
+	if not os.path.exists(destinationDir):
+		os.makedirs(destinationDir)
 
 	with rasterio.open(srcPath) as source:
 		# Define profile for reprojection
 		kwargs = source.profile
-		for prod in S2Products:
-			file_list = []
-			file_listTOA = []
-			
-			prod_name = os.path.basename(prod)
-			prod_name = prod_name[:len(prod_name) - 5]
-
-			# Create temporary folder for storage
-			destProd = os.path.join(destinationDir, prod_name)
-			destProdToa = os.path.join(destProd, 'TOA')
-			if not os.path.exists(destProd):
-				os.makedirs(destProd)
-			if not os.path.exists(destProdToa):
-				os.makedirs(destProdToa)
-
-			print("Reprojecting and stacking for S2 product: {}".format(prod_name))
-			if procLevel == "L1C":
-				imgPath = glob(os.path.join(prod, 'GRANULE', 'L*', 'IMG_DATA'))[0]
-			else:
-				imgPath = glob(os.path.join(prod, 'GRANULE', 'L*', 'IMG_DATA','R*'))[0]
-			
-			
-			print("    Reprojecting Bands: ")
-			for i, band_ in enumerate(bands_name):
-			
-				bfp = glob(os.path.join(imgPath, '*'+band_+'*'))[0]
-				
-				base = os.path.basename(bfp)
-				
-				base = base[:len(base) - band_name_base]
-				
-				print("        Band {}".format(base[-3:]))
-				basetif = base + '.tif'
-				
-				TOAband = os.path.join(destProdToa, base+'_TOA.tif')
-				file_listTOA.append(TOAband)
-				destBand = os.path.join(destProd, basetif)
-				
-				file_list.append(destBand)
-
-				with rasterio.open(bfp) as band:
-					kwargsTOA = band.profile
-					kwargsTOA.update({
-							'dtype': 'float32',
-							'driver':'Gtiff'
-						}
-					)
-					
-					bandTOA = band.read(1).astype('float32')/10000
-					with rasterio.open(TOAband, 'w', **kwargsTOA) as dstTOA:
-						dstTOA.write(bandTOA, 1)
-						
-				
-				with rasterio.open(TOAband) as srcTOA:
-					kwargs.update({'nodata': srcTOA.profile['nodata'],
-									"driver": 'Gtiff',
-									"dtype": "float32"})
-					
-					with rasterio.open(destBand, 'w', **kwargs) as dst:
-						warp.reproject(
-							rasterio.band(srcTOA, 1),
-							rasterio.band(dst, 1),
-							resampling=resampling_method(resampling_arg))
-
-			# Stack the rasters, the delete the temporary files
-			print("    Stacking bands...")
-
-			stackDest = os.path.join(destinationDir, prod_name + '_stacked.tif')
-
-			with rasterio.open(file_list[0]) as src0:
-				kwargs = src0.profile
-				kwargs.update(count=len(file_list))
-			with rasterio.open(stackDest, 'w', **kwargs) as dst:
-				for id, layer in enumerate(file_list, start=1):
-					with rasterio.open(layer) as src1:
-						dst.write_band(id, src1.read(1))
-					os.remove(layer)
-			for TOA in file_listTOA:
-				os.remove(TOA)
-			os.rmdir(destProdToa)
-			os.rmdir(destProd)
 
-			print("    Done!")
+	parameters = {'source': _fileHash(srcPath), 'procLevel': procLevel, 'resampling': resampling,
+				  'tiled': tiled, 'compress': compress, 'decimate': decimate, 'blocksize': blocksize,
+				  'max_z_error': max_z_error, 'dtype': dtype, 'window_warp': window_warp}
+	manifest = _readManifest(destinationDir)
+	records = dict(manifest)
+	listed = set()
+
+	def finish(prod_name, file_list, dst, futures, inputs, token):
+		print("Reprojecting and stacking for S2 product: {}".format(prod_name))
+		print("    Reprojecting Bands: ")
+		for future in futures:
+			future.result()
+		for bfp in file_list:
+			_printBand(bfp, band_name_base)
+		dst.close()
+		Instrumentation.stopStage(token)
+
+		records[prod_name] = {'inputs': inputs, 'output': _fileStat(dst.name)[1:]}
+		_writeManifest(destinationDir, records)
+		print("    Done!")
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		# Submit the bands of every product to the pool as the products are listed, each product is written to its
+		# own stacked raster, which is closed once all its bands are done
+		jobs = deque()
+		try:
+			for prod_name, file_list in S2Products:
+				listed.add(prod_name)
+				stackDest = os.path.join(destinationDir, prod_name + '_stacked.tif')
+				inputs = dict(parameters, bands=[_fileStat(bfp) for bfp in file_list])
+				record = manifest.get(prod_name)
+				if record is not None and record['inputs'] == inputs and os.path.exists(stackDest) \
+						and _fileStat(stackDest)[1:] == record['output']:
+					print("S2 product {} already processed, skipped".format(prod_name))
+					continue
+
+				kwargsStack = outputProfile(dict(kwargs, dtype=dtype), tiled=tiled, compress=compress,
+											blocksize=blocksize, max_z_error=max_z_error)
+
+				# With window_warp, the stacked raster only covers the window of the grid overlapping the product
+				with rasterio.open(file_list[0]) as band0:
+					nodata = band0.nodata
+					window = targetWindow(band0.bounds, band0.crs, kwargsStack, crop=window_warp)
+				if window is None:
+					print("S2 product {} does not overlap the source raster, skipped".format(prod_name))
+					continue
+
+				kwargsStack = windowProfile(kwargsStack, window)
+				kwargsStack.update({'count': len(file_list),
+									'nodata': nodata,
+									"driver": 'Gtiff',
+									"dtype": dtype})
+
+				# Time from the submission of the first band to the stacked raster being closed
+				token = Instrumentation.startStage('reprojectProduct', product=prod_name)
+				dst = rasterio.open(stackDest, 'w', **kwargsStack)
+				_writeScaling(dst)
+				lock = Lock()
+				# The bands of each resolution are warped together
+				futures = [pool.submit(_reprojectStackBands, [bfp for id, bfp in group], [id for id, bfp in group],
+									   dst, lock, kwargsStack, resampling, num_threads, decimate)
+						   for group in bandGroups(file_list)]
+				jobs.append((prod_name, file_list, dst, futures, inputs, token))
+
+				while jobs and all(future.done() for future in jobs[0][3]):
+					finish(*jobs[0])
+					jobs.popleft()
+
+			while jobs:
+				finish(*jobs[0])
+				jobs.popleft()
+		finally:
+			for prod_name, file_list, dst, futures, inputs, token in jobs:
+				dst.close()
+
+	# Stacked rasters of products that are no longer listed would otherwise end up in the merge
+	for prod_name in set(records) - listed:
+		stale = os.path.join(destinationDir, prod_name + '_stacked.tif')
+		if os.path.exists(stale):
+			os.remove(stale)
+		del records[prod_name]
+	_writeManifest(destinationDir, records)
 	print("All products in directory done processing!")
 
 
-def MergeRasters(srcDir, dstDir, srcImgformat='tif', returnMerge=False):
+merge_methods = ('first', 'last', 'max', 'mean')
+
+
+def _composite(merged, filled, data, valid, method, total=None, count=None):
 	"""
-		Merging rasters located in srcDir and written to 'merged.imgformat' in destDir
+		Composite data into merged in place at the pixels where data is valid, filled marks the pixels of merged that
+		already hold a value. For 'mean' the running sum and number of valid values are kept in total and count.
+	"""
+	if method == 'first':
+		update = valid & ~filled
+	elif method == 'last':
+		update = valid
+	elif method == 'max':
+		update = valid & (~filled | (data > merged))
+	elif method == 'mean':
+		total[valid] += data[valid]
+		count[valid] += 1
+		update = valid
+		data = total / np.maximum(count, 1)
+		if np.issubdtype(merged.dtype, np.integer):
+			data = np.rint(data)
+	merged[update] = data[update]
+	filled |= update
+
+
+def _mergeWindow(datasets, window, transform, dtype, nodata=0, method='first'):
+	"""
+		Merge the part of datasets overlapping window of the output grid given by transform, only the overlapping
+		window of each dataset is read
+	"""
+	count = datasets[0].count
+	left, bottom, right, top = rasterio.windows.bounds(window, transform)
+	window_transform = rasterio.windows.transform(window, transform)
+
+	merged = np.full((count, window.height, window.width), nodata, dtype=dtype)
+	filled = np.zeros(merged.shape, dtype=bool)
+	total = np.zeros(merged.shape, dtype='float64') if method == 'mean' else None
+	n_valid = np.zeros(merged.shape, dtype='uint16') if method == 'mean' else None
+
+	for src in datasets:
+		# Intersection of the output window and the dataset
+		int_w, int_s = max(left, src.bounds.left), max(bottom, src.bounds.bottom)
+		int_e, int_n = min(right, src.bounds.right), min(top, src.bounds.top)
+		if int_w >= int_e or int_s >= int_n:
+			continue
+
+		src_window = rasterio.windows.from_bounds(int_w, int_s, int_e, int_n, src.transform)
+		dst_window = rasterio.windows.from_bounds(int_w, int_s, int_e, int_n, window_transform)
+		row_off, col_off = max(0, int(round(dst_window.row_off))), max(0, int(round(dst_window.col_off)))
+		rows = min(int(round(dst_window.height)), window.height - row_off)
+		cols = min(int(round(dst_window.width)), window.width - col_off)
+		if rows <= 0 or cols <= 0:
+			continue
+
+		data = src.read(window=src_window, out_shape=(count, rows, cols), masked=True)
+		valid = ~np.ma.getmaskarray(data) & (data.data != nodata)
+
+		region = (slice(None), slice(row_off, row_off + rows), slice(col_off, col_off + cols))
+		_composite(merged[region], filled[region], data.data, valid, method,
+				   total=None if total is None else total[region], count=None if n_valid is None else n_valid[region])
+
+	return merged
+
+
+@instrumented()
+def MergeRasters(srcDir, dstDir, srcImgformat='tif', returnMerge=False, method='first', window_size=1024, nodata=0,
+				 referencePath=None, tiled=None, compress=None, blocksize=None, max_z_error=0):
+	"""
+		Merging rasters located in srcDir and written to 'merged.imgformat' in destDir. The merge is streamed window by
+		window, so peak memory is bounded by window_size and not by the size of the mosaic.
+
+		method: Compositing of overlapping valid pixels, 'first', 'last', 'max' or 'mean' of the valid values
+		window_size: Width and height of the output windows in pixels
+		nodata: Pixel value treated as no data in the inputs and used to fill the output
+
+		The output has the dtype, scales and offsets of the first raster, integer DN stay integer DN
+		referencePath: Raster defining the output grid, default is the union of the rasters at the resolution of the first
+		tiled, compress, blocksize, max_z_error: Tiling and compression of the output, see outputProfile. The tiling,
+			block size and compression of the first raster are kept by default, with the predictor of its dtype
 	"""
 	if not os.path.exists(dstDir):
 		os.makedirs(dstDir)
 	if srcImgformat not in ('tif', 'jp2', 'TIF'):
 		raise ValueError("Invalid image format, choose one of these instead: ('tif', 'jp2', 'TIF')")
-	rasters = glob(os.path.join(srcDir, '*.{}'.format(srcImgformat)))
+	if method not in merge_methods:
+		raise ValueError("Invalid merge method, choose one of these instead: {}".format(merge_methods))
+	# Sorted like the products, so 'first' and 'last' do not depend on the order of the directory entries
+	rasters = sorted(glob(os.path.join(srcDir, '*.{}'.format(srcImgformat))))
 	destination = os.path.join(dstDir, 'merged.{}'.format(srcImgformat))
 	datasets = []
 
 	for img in rasters:
 		datasets.append(rasterio.open(img))
 
-	merged, output_transform = merge(datasets, nodata=0)
+	try:
+		kwargs = datasets[0].profile
+		# The profile of a raster has no predictor nor LERC error, outputProfile sets them for the compression
+		if tiled is None:
+			tiled = kwargs.get('tiled', False)
+		if blocksize is None:
+			blocksize = kwargs.get('blockxsize', 256) if tiled else 256
+		if compress is None:
+			compress = kwargs.get('compress')
+		for option in ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor', 'max_z_error'):
+			kwargs.pop(option, None)
+		kwargs = outputProfile(kwargs, tiled=tiled, compress=compress, blocksize=blocksize, max_z_error=max_z_error)
+		if referencePath is not None:
+			with rasterio.open(referencePath) as reference:
+				output_transform = reference.transform
+				kwargs.update({'transform': output_transform,
+							   'width': reference.width,
+							   'height': reference.height})
+		else:
+			# Output grid covering all rasters, with the resolution of the first
+			res = datasets[0].res
+			left = min(src.bounds.left for src in datasets)
+			bottom = min(src.bounds.bottom for src in datasets)
+			right = max(src.bounds.right for src in datasets)
+			top = max(src.bounds.top for src in datasets)
+			output_transform = Affine.translation(left, top) * Affine.scale(res[0], -res[1])
+
+			kwargs.update({'transform': output_transform,
+						   'width': int(round((right - left) / res[0])),
+						   'height': int(round((top - bottom) / res[1]))})
+
+		with rasterio.open(destination, 'w', **kwargs) as dst:
+			if datasets[0].scales != (1.0,) * dst.count or datasets[0].offsets != (0.0,) * dst.count:
+				dst.scales = datasets[0].scales
+				dst.offsets = datasets[0].offsets
+			for row in range(0, dst.height, window_size):
+				for col in range(0, dst.width, window_size):
+					window = Window(col, row, min(window_size, dst.width - col), min(window_size, dst.height - row))
+					dst.write(_mergeWindow(datasets, window, output_transform, kwargs['dtype'], nodata=nodata,
+										   method=method), window=window)
+	finally:
+		for sets in datasets:
+			sets.close()
 
-	with rasterio.open(rasters[0]) as src:
-		kwargs = src.profile
-	with rasterio.open(destination, 'w', **kwargs) as dst:
-		dst.write(merged)
-
-	for sets in datasets:
-		sets.close()
 	if returnMerge:
-		return merged
+		with rasterio.open(destination) as src:
+			return src.read()
 	else:
-		del merged
 		return None
 
-temporary_dir = os.path.join(dest, 'tmp')
-ReprojectS2Products(SITPath, S2path, destinationDir=temporary_dir, procLevel=processing_level)
 
-print("Merging rasters..")
-MergeRasters(srcDir=temporary_dir, dstDir=dest, srcImgformat='tif', returnMerge=False)
+def _orderedResults(pool, func, tasks, max_pending):
+	"""
+		Run func over the argument tuples in tasks in the pool and yield the results in task order, with at most
+		max_pending tasks submitted or finished but not yet consumed
+	"""
+	pending = deque()
+	for task in tasks:
+		pending.append(pool.submit(func, *task))
+		if len(pending) >= max_pending:
+			yield pending.popleft().result()
+	while pending:
+		yield pending.popleft().result()
+
+
+@instrumented()
+def ReprojectMergeS2Products(srcPath, S2Dir, destination, procLevel, bands_name=None, resampling='nearest', workers=1,
+							 num_threads=1, method='first', nodata=0, tiled=False, compress=None, decimate=False,
+							 blocksize=256, max_z_error=0, dtype='float32', window_warp=False):
+	"""
+		Reproject the bands of several S2 products directly into one shared raster on the grid of the source raster,
+		compositing each product as it lands. Replaces ReprojectS2Products followed by MergeRasters, without the
+		per-product stacked rasters.
+
+		srcPath: Path to source raster.
+		S2Dir: Path to directory of S2 products in .SAFE format, extracted or zipped, or an iterable of product paths
+			consumed as the products become available
+		destination: Path to the merged output raster
+		procLevel: S2 processing level, L1C or L2A
+		bands_name: Bands to reproject, default is all bands of the processing level
+		resampling: Resampling method, see resampling_method
+		workers: Number of band groups (bands of the same resolution), across all products, reprojected at the same
+			time
+		num_threads: Number of GDAL warp threads used for each band group
+		method: Compositing of overlapping valid pixels, 'first', 'last', 'max' or 'mean', products are composited in
+			the order they are listed (or arrive), 'mean' keeps a sum and count of valid values per pixel and band in
+			memory
+		nodata: Pixel value treated as no data when compositing
+		tiled: Write the output with internal tiling
+		compress: Compression of the output, e.g. 'deflate', 'zstd' or 'lerc', see outputProfile
+		decimate: Read the bands at a reduced resolution close to the pixel size of the source raster
+		blocksize: Width and height of the blocks of a tiled output
+		max_z_error: Maximum error of LERC compression
+		dtype: 'float32' for TOA reflectance, or 'uint16' or 'int16' to keep the DN with a scale, see
+			ReprojectS2Products
+		window_warp: Warp and composite each product in the window of the grid overlapping it only, see
+			ReprojectS2Products
+	"""
+	if method not in merge_methods:
+		raise ValueError("Invalid merge method, choose one of these instead: {}".format(merge_methods))
+
+	S2Products, band_name_base = _listProductBands(S2Dir, procLevel, bands_name)
+	first = next(S2Products, None)
+	if first is None:
+		raise ValueError("No S2 products found in {}".format(S2Dir))
+	S2Products = chain([first], S2Products)
 
-files = glob(os.path.join(temporary_dir, '*'))
-for file in files:
-	os.remove(file)
+	if not os.path.exists(os.path.dirname(os.path.abspath(destination))):
+		os.makedirs(os.path.dirname(os.path.abspath(destination)))
 
-os.rmdir(temporary_dir)
+	with rasterio.open(srcPath) as source:
+		# Define profile for reprojection
+		kwargs = source.profile
+
+	with rasterio.open(first[1][0]) as band0:
+		kwargs = outputProfile(dict(kwargs, dtype=dtype), tiled=tiled, compress=compress, blocksize=blocksize,
+							   max_z_error=max_z_error)
+		kwargs.update({'count': len(first[1]),
+					   'nodata': band0.nodata,
+					   "driver": 'Gtiff',
+					   "dtype": dtype})
+
+	# With window_warp, only the window of the grid overlapping each product is warped and composited
+	def overlapping():
+		for prod_name, file_list in S2Products:
+			with rasterio.open(file_list[0]) as band0:
+				window = targetWindow(band0.bounds, band0.crs, kwargs, crop=window_warp)
+			if window is None:
+				print("S2 product {} does not overlap the source raster, skipped".format(prod_name))
+				continue
+			yield prod_name, window, bandGroups(file_list)
+
+	# Products are listed lazily, the warps run ahead of the compositing loop. The bands of each resolution are
+	# warped together
+	jobs, jobsAhead = tee(overlapping())
+	tasks = (([bfp for id, bfp in group], windowProfile(kwargs, window), resampling, num_threads, decimate)
+			 for prod_name, window, groups in jobsAhead for group in groups)
+	# Running sum and number of valid values of each band for 'mean', kept in float64 as the output may be rounded
+	totals, counts = {}, {}
+
+	with ThreadPoolExecutor(max_workers=workers) as pool, rasterio.open(destination, 'w+', **kwargs) as dst:
+		_writeScaling(dst)
+		results = _orderedResults(pool, _reprojectBands, tasks, max_pending=2 * workers)
+
+		for prod_name, window, groups in jobs:
+			print("Reprojecting and merging S2 product: {}".format(prod_name))
+			print("    Reprojecting Bands: ")
+			region = (slice(window.row_off, window.row_off + window.height),
+					  slice(window.col_off, window.col_off + window.width))
+			for group in groups:
+				reprojected = next(results)
+				token = Instrumentation.startStage('compositeBands', product=prod_name,
+												   bands=','.join(os.path.basename(bfp) for id, bfp in group))
+				for (id, bfp), data in zip(group, reprojected):
+					valid = data != nodata
+
+					# Blocks that were never written are read as the nodata value of the output, or 0 if it has none
+					merged = dst.read(id, window=window)
+					filled = merged != nodata
+					if kwargs['nodata'] is not None:
+						filled &= merged != kwargs['nodata']
+
+					total = count = None
+					if method == 'mean':
+						if id not in counts:
+							totals[id] = np.zeros((kwargs['height'], kwargs['width']), dtype='float64')
+							counts[id] = np.zeros((kwargs['height'], kwargs['width']), dtype='uint16')
+						total = totals[id][region]
+						count = counts[id][region]
+
+					_composite(merged, filled, data, valid, method, total=total, count=count)
+					dst.write(merged, id, window=window)
+					_printBand(bfp, band_name_base)
+				Instrumentation.stopStage(token)
 
-print("Done merging, final product will be found in destination: {}, with the name merged.tif".format(dest))
+			print("    Done!")
+	print("All products in directory done processing!")
+
+
+def selectBands(procLevel, bandsarg=('all',)):
+	"""
+		Check the bands given for a processing level, returns the list of band names
+
+		procLevel: 'L1C' or 'L2A'
+		bandsarg: band names, or ['all'] for every band of the processing level
+	"""
+	if procLevel == "L1C":
+		all_bands = all_bands_1C
+	elif procLevel == "L2A":
+		all_bands = all_bands_2A
+	else:
+		raise ValueError("--ProcessingLevel must either be L1C or L2A")
+
+	if bandsarg[0] == 'all':
+		return all_bands
+	checkbands = [i for i in bandsarg if i in all_bands]
+	if len(checkbands)==0:
+		raise ValueError("--bands must contain at least one of these elements: {}".format(", ".join(all_bands)))
+	return list(bandsarg)
+
+
+@instrumented()
+def ProcessS2Products(srcPath, S2Dir, destination, procLevel='L1C', bands_name=None, resampling='nearest', workers=1,
+					  num_threads=1, method='first', window_size=1024, direct_merge=False, tiled=False,
+					  compress=None, decimate=False, keep_temporary=False, blocksize=256, max_z_error=0,
+					  overviews=False, cog=False, dtype='float32', window_warp=False):
+	"""
+		Reproject and merge the S2 products to the grid of a source raster, the library version of running the
+		script. The final product is written to merged.tif in destination.
+
+		The stacked rasters are written to destination/tmp, which is removed after the merge unless keep_temporary.
+		An interrupted run, or a run with keep_temporary, is resumed by the next run, see ReprojectS2Products.
+		merged.tif gets internal overviews with overviews, or is rewritten as a COG with cog, see finalizeOutput.
+
+		See the script arguments for the parameters
+
+		Returns the path to merged.tif
+	"""
+	if bands_name is None:
+		bands_name = selectBands(procLevel)
+	merged = os.path.join(destination, 'merged.tif')
+
+	if direct_merge:
+		ReprojectMergeS2Products(srcPath, S2Dir, merged, procLevel=procLevel,
+								 bands_name=bands_name, resampling=resampling, workers=workers,
+								 num_threads=num_threads, method=method, tiled=tiled, compress=compress,
+								 decimate=decimate, blocksize=blocksize, max_z_error=max_z_error, dtype=dtype,
+								 window_warp=window_warp)
+	else:
+		temporary_dir = os.path.join(destination, 'tmp')
+		ReprojectS2Products(srcPath, S2Dir, destinationDir=temporary_dir, procLevel=procLevel,
+							bands_name=bands_name, resampling=resampling, workers=workers, num_threads=num_threads,
+							tiled=tiled, compress=compress, decimate=decimate, blocksize=blocksize,
+							max_z_error=max_z_error, dtype=dtype, window_warp=window_warp)
+
+		print("Merging rasters..")
+		MergeRasters(srcDir=temporary_dir, dstDir=destination, srcImgformat='tif', returnMerge=False, method=method,
+					 window_size=window_size, referencePath=srcPath, tiled=tiled, compress=compress,
+					 blocksize=blocksize, max_z_error=max_z_error)
+
+		if not keep_temporary:
+			files = glob(os.path.join(temporary_dir, '*'))
+			for file in files:
+				os.remove(file)
+
+			os.rmdir(temporary_dir)
+
+	finalizeOutput(merged, overviews=overviews, cog=cog, max_z_error=max_z_error)
+
+	return merged
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	optional = parser._action_groups.pop()
+	required = parser.add_argument_group("required arguments")
+
+	required.add_argument("--ProcessingLevel", help="Specify S2 processing level, default=L1C", default="L1C")
+	required.add_argument("--SrcPath", help="Path to src product corresponding to the S2 products",
+						  required=True)
+	required.add_argument("--S2Source", help="Path to S2 products source folder", required=True)
+	required.add_argument("--destination", help="Path to destination of reprojected and merged products",
+						  required=True)
+
+	required.add_argument('--bands', '--names-list', nargs='+', default=['all'], 
+						  help="Define bands you want to keep, default=all")
+	required.add_argument('--resampling', default="nearest",help="Resampling method to use from rasterio.warp.Resampling, default=nearest")
+	required.add_argument('--workers', default=1, type=int,
+						  help="Number of band groups (bands of the same resolution), across all products, reprojected "
+							   "at the same time, default=1")
+	required.add_argument('--num_threads', default=1, type=int,
+						  help="Number of GDAL warp threads used for each band group, default=1")
+	required.add_argument('--merge_method', default="first", choices=merge_methods,
+						  help="Compositing of overlapping valid pixels in the merge, default=first")
+	required.add_argument('--window_size', default=1024, type=int,
+						  help="Width and height in pixels of the windows the merge is written in, default=1024")
+	required.add_argument('--direct_merge', action='store_true',
+						  help="Reproject all products directly into merged.tif, without per-product rasters")
+	required.add_argument('--tiled', action='store_true', help="Write the output rasters with internal tiling")
+	required.add_argument('--compress', default=None,
+						  help="Compression of the output rasters, e.g. deflate, lzw, zstd or lerc, default=None")
+	required.add_argument('--blocksize', default=256, type=int,
+						  help="Width and height of the blocks of tiled output rasters, default=256")
+	required.add_argument('--max_z_error', default=0, type=float,
+						  help="Maximum error of LERC compression, default=0 (lossless)")
+	required.add_argument('--overviews', action='store_true', help="Build internal overviews in merged.tif")
+	required.add_argument('--cog', action='store_true',
+						  help="Write merged.tif as a Cloud Optimized GeoTIFF, with overviews")
+	required.add_argument('--dtype', default='float32', choices=output_dtypes,
+						  help="Data type of the output rasters, float32 TOA reflectance or the uint16/int16 DN with "
+							   "a reflectance scale in the metadata, default=float32")
+	required.add_argument('--decimate', action='store_true',
+						  help="Read the bands at a reduced resolution close to the pixel size of SrcPath")
+	required.add_argument('--window_warp', action='store_true',
+						  help="Warp each product into the window of SrcPath overlapping it only, faster but not "
+							   "identical to warping into the whole grid")
+	required.add_argument('--keep_temporary', action='store_true',
+						  help="Keep the stacked rasters in destination/tmp, a later run only reprocesses new or "
+							   "changed products")
+	required.add_argument('--archive', action='store_true',
+						  help="S2Source is an archive, only the products overlapping SrcPath are processed, selected "
+							   "with the indexed product footprints and sensing times")
+	required.add_argument('--delta', default="hours=1",
+						  help="Time difference from SrcPath of the products selected with --archive, default=hours=1")
+	required.add_argument('--profile_out', default=None,
+						  help="Write the time, memory and I/O of each processing stage to this .json or .csv file, "
+							   "default=None")
+
+
+	args = parser.parse_args()
+	S2path =args.S2Source
+	SITPath = args.SrcPath
+	dest = args.destination
+	bandsarg = args.bands
+	resampling_arg = args.resampling
+	processing_level = args.ProcessingLevel
+	workers = args.workers
+	num_threads = args.num_threads
+	merge_method = args.merge_method
+	window_size = args.window_size
+	direct_merge = args.direct_merge
+	tiled = args.tiled
+	compress = args.compress
+	decimate = args.decimate
+	keep_temporary = args.keep_temporary
+	blocksize = args.blocksize
+	max_z_error = args.max_z_error
+	overviews = args.overviews
+	cog = args.cog
+	dtype = args.dtype
+	window_warp = args.window_warp
+	archive = args.archive
+	delta = args.delta
+	profile_out = args.profile_out
+
+	if profile_out is not None:
+		Instrumentation.enable()
+
+	bands_name = selectBands(processing_level, bandsarg)
+
+	if archive:
+		S2path = selectArchiveProducts(S2path, SITPath, '*MSIL1C*' if processing_level == 'L1C' else '*MSIL2A*',
+									   date=deltaTimeSIT(SITPath, delta))
+		print("{} products in the archive overlap {}".format(len(S2path), SITPath))
+		if len(S2path) == 0:
+			raise ValueError("No products in the archive overlap {} within {}".format(SITPath, delta))
+
+	ProcessS2Products(SITPath, S2path, dest, procLevel=processing_level, bands_name=bands_name,
+					  resampling=resampling_arg, workers=workers, num_threads=num_threads, method=merge_method,
+					  window_size=window_size, direct_merge=direct_merge, tiled=tiled, compress=compress,
+					  decimate=decimate, keep_temporary=keep_temporary, blocksize=blocksize, max_z_error=max_z_error,
+					  overviews=overviews, cog=cog, dtype=dtype, window_warp=window_warp)
+
+	print("Done merging, final product will be found in destination: {}, with the name merged.tif".format(dest))
+
+	if profile_out is not None:
+		print("Processing profile written to: {}".format(Instrumentation.exportRecords(profile_out)))
 
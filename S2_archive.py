@@ -0,0 +1,130 @@
+"""
+Spatial index over a local archive of Sentinel-2 products, to select the products overlapping a mask without the hub.
+
+The footprints and sensing times come from the product metadata, indexed and cached by S2_safe.indexProducts, and the
+footprints are put in a shapely STRtree. An archive of thousands of products is then queried in milliseconds, e.g.
+
+    archive = buildArchiveIndex('/data/S2', '*MSIL1C*')
+    products = queryArchive(archive, rasterFootprint(maskPath), date=(starttime, endtime))
+"""
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+import numpy as np
+import rasterio
+import shapely.geometry
+from shapely.strtree import STRtree
+
+from CRS_transform import transformGeometries
+from S2_safe import indexProducts, productName
+
+ArchiveIndex = namedtuple('ArchiveIndex', ['tree', 'footprints', 'products'])
+
+
+def footprintPolygon(coords):
+    """
+    Polygon in longitude/latitude of a product footprint
+
+    :param coords: EXT_POS_LIST of the product metadata, alternating latitude and longitude
+    :return: shapely Polygon
+    """
+    latlon = np.asarray(coords, dtype='float64').reshape(-1, 2)
+    return shapely.geometry.Polygon(latlon[:, ::-1]).buffer(0)
+
+
+def _sensingTime(text):
+    """
+    Sensing time of the product metadata as a datetime in UTC, e.g. '2019-03-11T11:18:01.024Z'
+    """
+    return datetime.strptime(text[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def rasterFootprint(path, points=21):
+    """
+    Footprint of a raster in longitude/latitude, from its bounds with points vertices along each side so the
+    footprint follows the curved edges of a polar grid
+
+    :param path: path to the raster
+    :param points: number of vertices along each side
+    :return: shapely Polygon
+    """
+    with rasterio.open(path) as src:
+        left, bottom, right, top = src.bounds
+        crs = src.crs
+    t = np.linspace(0, 1, points)[:-1]
+    xs = np.concatenate((left + t * (right - left), np.full(t.shape, right), right - t * (right - left),
+                         np.full(t.shape, left)))
+    ys = np.concatenate((np.full(t.shape, top), top - t * (top - bottom), np.full(t.shape, bottom),
+                         bottom + t * (top - bottom)))
+    ring = shapely.geometry.Polygon(np.column_stack((xs, ys)))
+    return shapely.geometry.shape(transformGeometries(crs, 'EPSG:4326', [ring])[0])
+
+
+def buildArchiveIndex(S2Dir, pattern='*MSIL1C*', cache_path=None):
+    """
+    Build the spatial index of the products in an archive directory
+
+    :param S2Dir: directory with the products, extracted (.SAFE) or zipped (.zip)
+    :param pattern: glob pattern of the product names
+    :param cache_path: path to the metadata cache, see S2_safe.indexProducts
+    :return: ArchiveIndex with the STRtree, the footprints and the products, each a dict with 'identifier',
+        'title', 'path', 'footprint' (WKT), 'beginposition' (sensing time) and 'tile_id'
+    """
+    products = []
+    footprints = []
+    for prod, metadata in indexProducts(S2Dir, pattern, cache_path=cache_path).items():
+        footprint = footprintPolygon(metadata['footprint'])
+        footprints.append(footprint)
+        products.append({'identifier': productName(prod), 'title': productName(prod), 'path': prod,
+                         'footprint': footprint.wkt, 'beginposition': _sensingTime(metadata['sensing_time']),
+                         'tile_id': metadata['tile_id']})
+    return ArchiveIndex(STRtree(footprints) if footprints else None, footprints, products)
+
+
+def queryArchive(archive, geometry, date=None):
+    """
+    Products of an archive intersecting a geometry, optionally sensed within a time interval
+
+    :param archive: ArchiveIndex from buildArchiveIndex
+    :param geometry: shapely or GeoJSON-like geometry in longitude/latitude
+    :param date: (start, end) datetimes in UTC, default None (any time)
+    :return: ordered dictionary of product metadata keyed by product name, in the form of a hub query result
+    """
+    if not isinstance(geometry, shapely.geometry.base.BaseGeometry):
+        geometry = shapely.geometry.shape(geometry)
+    if not geometry.is_valid:
+        geometry = geometry.buffer(0)
+
+    found = OrderedDict()
+    if archive.tree is None:
+        return found
+
+    hits = archive.tree.query(geometry)
+    if len(hits) > 0 and not isinstance(hits[0], (int, np.integer)):
+        # Shapely 1.x returns the geometries instead of their indexes
+        positions = {id(footprint): i for i, footprint in enumerate(archive.footprints)}
+        hits = [positions[id(hit)] for hit in hits]
+
+    # The tree only compares bounding boxes
+    for i in sorted(int(hit) for hit in hits):
+        prod = archive.products[i]
+        if date is not None and not date[0] <= prod['beginposition'] <= date[1]:
+            continue
+        if archive.footprints[i].intersects(geometry):
+            found[prod['identifier']] = prod
+    return found
+
+
+def selectArchiveProducts(S2Dir, srcPath, pattern='*MSIL1C*', date=None, cache_path=None):
+    """
+    Paths of the products in an archive directory overlapping a raster, for S2_Reproject_Merge
+
+    :param S2Dir: directory with the products, extracted (.SAFE) or zipped (.zip)
+    :param srcPath: path to the raster
+    :param pattern: glob pattern of the product names
+    :param date: (start, end) datetimes in UTC, default None (any time)
+    :param cache_path: path to the metadata cache, see S2_safe.indexProducts
+    :return: list of product paths
+    """
+    archive = buildArchiveIndex(S2Dir, pattern, cache_path=cache_path)
+    return [prod['path'] for prod in queryArchive(archive, rasterFootprint(srcPath), date=date).values()]
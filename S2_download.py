@@ -0,0 +1,174 @@
+"""
+Concurrent download of Sentinel-2 products from the hub, with resume of partial downloads and MD5 verification.
+
+Products are downloaded to <title>.zip.incomplete and renamed to <title>.zip once the checksum matches. An interrupted
+download is resumed from the end of the .incomplete file with an HTTP range request. Products with a <title>.SAFE
+directory or a complete <title>.zip in the destination are skipped.
+
+With a queue the downloaded products are handed to the processing as they arrive, for instance:
+
+    products = queue.Queue()
+    Thread(target=downloadProducts, args=(kept_products, S2Dir), kwargs={'api': api, 'unzip': True,
+                                                                         'queue': products}).start()
+    ReprojectS2Products(srcPath, iterQueue(products), destinationDir, 'L1C')
+"""
+import hashlib
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _md5(path, chunk_size=2 ** 20):
+    """
+    MD5 hash object of a file, to be updated with the rest of a resumed download
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5
+
+
+def _unzipProduct(zip_path, destination):
+    """
+    Extract a downloaded product into destination and remove the zip. The product is extracted next to the zip and
+    moved in place when complete, so an interrupted extraction never leaves a partial .SAFE directory
+
+    :return: path to the .SAFE directory
+    """
+    tmp_dir = zip_path + '.extracting'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    with zipfile.ZipFile(zip_path) as zf:
+        safe_name = zf.namelist()[0].split('/')[0]
+        zf.extractall(tmp_dir)
+    safe_path = os.path.join(destination, safe_name)
+    os.replace(os.path.join(tmp_dir, safe_name), safe_path)
+    shutil.rmtree(tmp_dir)
+    os.remove(zip_path)
+    return safe_path
+
+
+def downloadProduct(odata, destination, session, unzip=False, chunk_size=2 ** 20, retries=3):
+    """
+    Download one product, resuming a partial download and verifying the MD5 checksum
+
+    :param odata: product information from SentinelAPI.get_product_odata, needs 'title', 'url' and 'md5'
+    :param destination: directory the product is downloaded to
+    :param session: requests.Session, authenticated for the hub
+    :param unzip: extract the product to <title>.SAFE and remove the zip
+    :param chunk_size: bytes read from the response at a time
+    :param retries: number of times the download is restarted after a checksum mismatch or a connection error
+    :return: path to the .zip, or to the .SAFE directory if unzip
+    """
+    title = odata['title']
+    safe_path = os.path.join(destination, title + '.SAFE')
+    zip_path = os.path.join(destination, title + '.zip')
+    part_path = zip_path + '.incomplete'
+
+    if os.path.isdir(safe_path):
+        print("{} already downloaded, skipping".format(title))
+        return safe_path
+    if os.path.exists(zip_path) and ('size' not in odata or os.path.getsize(zip_path) == odata['size']):
+        print("{} already downloaded, skipping".format(title))
+        return _unzipProduct(zip_path, destination) if unzip else zip_path
+
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+            with session.get(odata['url'], headers=headers, stream=True) as response:
+                if offset > 0 and response.status_code == 416:
+                    # The partial file is already complete
+                    md5 = _md5(part_path, chunk_size)
+                else:
+                    response.raise_for_status()
+                    if offset > 0 and response.status_code == 206:
+                        print("Resuming {} from {} MB".format(title, offset // 2 ** 20))
+                        md5 = _md5(part_path, chunk_size)
+                        mode = 'ab'
+                    else:
+                        md5 = hashlib.md5()
+                        mode = 'wb'
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            md5.update(chunk)
+        except OSError as e:
+            # requests.ConnectionError and friends are OSErrors, the partial file is kept for the next attempt
+            if attempt == retries:
+                raise
+            print("Download of {} interrupted ({}), retrying".format(title, e))
+            continue
+
+        if md5.hexdigest().lower() == odata['md5'].lower():
+            os.replace(part_path, zip_path)
+            print("Downloaded {}".format(title))
+            return _unzipProduct(zip_path, destination) if unzip else zip_path
+
+        os.remove(part_path)
+        if attempt == retries:
+            raise RuntimeError("Checksum of {} does not match after {} attempts".format(title, retries + 1))
+        print("Checksum of {} does not match, downloading again".format(title))
+
+
+def downloadProducts(products, destination, api=None, session=None, get_odata=None, workers=2, unzip=False,
+                     retries=3, queue=None):
+    """
+    Download products with a bounded number of concurrent downloads
+
+    :param products: list of product metadata with a 'uuid', e.g. kept_products from Mask_S2_Overlap.py
+    :param destination: directory the products are downloaded to
+    :param api: SentinelAPI, provides the session and product information if they are not given
+    :param session: requests.Session used for the downloads, default api.session
+    :param get_odata: function returning the product information of a uuid, default api.get_product_odata
+    :param workers: number of products downloaded at the same time
+    :param unzip: extract the products to .SAFE directories
+    :param retries: number of times a failed download is restarted
+    :param queue: queue.Queue the path of each product is put in as soon as it is downloaded, followed by None when
+        all downloads are done. Lets the products be processed while the rest are downloading, see iterQueue
+    :return: dict of uuid: path to the downloaded product, None for products that failed or are offline
+    """
+    if session is None:
+        session = api.session
+    if get_odata is None:
+        get_odata = api.get_product_odata
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+
+    def download(prod):
+        odata = get_odata(prod['uuid'])
+        if not odata.get('Online', True):
+            print("{} is in the long term archive, not downloaded".format(odata['title']))
+            return None
+        path = downloadProduct(odata, destination, session, unzip=unzip, retries=retries)
+        if queue is not None:
+            queue.put(path)
+        return path
+
+    paths = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(prod['uuid'], pool.submit(download, prod)) for prod in products]
+            for uuid, future in futures:
+                try:
+                    paths[uuid] = future.result()
+                except Exception as e:
+                    print("Download of {} failed, {!r}".format(uuid, e))
+                    paths[uuid] = None
+    finally:
+        if queue is not None:
+            queue.put(None)
+    return paths
+
+
+def iterQueue(queue):
+    """
+    Iterate over the product paths put in a queue by downloadProducts, until all downloads are done
+
+    :param queue: queue.Queue given to downloadProducts
+    :return: generator of product paths
+    """
+    for path in iter(queue.get, None):
+        yield path
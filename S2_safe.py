@@ -0,0 +1,241 @@
+"""
+Access to the files of Sentinel-2 products in .SAFE format, either extracted or still zipped as downloaded from the hub.
+
+Files in a zipped product are read through GDAL's /vsizip/ virtual filesystem, e.g.
+
+    /vsizip//data/S2A_MSIL1C_....zip/S2A_MSIL1C_....SAFE/GRANULE/L1C_.../IMG_DATA/..._B01.jp2
+
+so rasterio opens them like any other file, and the XML metadata is read with zipfile. Nothing is extracted to disk.
+
+The metadata needed to select products (footprint, sensing time, tile and band files) is read by readMetadata, which
+stops parsing at the footprint, and indexed per directory by indexProducts in a JSON cache, so an archive is only
+parsed once.
+"""
+import json
+import os
+import posixpath
+import re
+import tempfile
+import zipfile
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from glob import glob
+
+from lxml.etree import iterparse
+
+VSIZIP = '/vsizip/'
+metadata_cache_name = 'S2_metadata.json'
+
+
+def isZipProduct(prod):
+    """
+    True if prod is a zipped product
+    """
+    return prod.lower().endswith('.zip')
+
+
+def productName(prod):
+    """
+    Name of a product without the .SAFE or .zip extension
+
+    :param prod: path to the .SAFE directory or the .zip
+    :return: product name
+    """
+    return os.path.splitext(os.path.basename(os.path.normpath(prod)))[0]
+
+
+def listProducts(S2Dir, pattern='*'):
+    """
+    List the products in a directory, extracted (.SAFE) and zipped (.zip). A product present both extracted and zipped
+    is listed once, as the .SAFE directory. The products are sorted by name, so the products composited first do not
+    depend on the order of the directory entries
+
+    :param S2Dir: directory with the products
+    :param pattern: glob pattern of the product names, e.g. '*MSIL1C*'
+    :return: sorted list of paths to the .SAFE directories and .zip files
+    """
+    safes = glob(os.path.join(S2Dir, pattern + '.SAFE'))
+    extracted = set(productName(prod) for prod in safes)
+    zips = [prod for prod in glob(os.path.join(S2Dir, pattern + '.zip')) if productName(prod) not in extracted]
+    return sorted(safes + zips, key=productName)
+
+
+@lru_cache(maxsize=128)
+def _zipMembers(zip_path, mtime):
+    # mtime is part of the key so a replaced zip is listed again
+    with zipfile.ZipFile(zip_path) as zf:
+        return tuple(zf.namelist())
+
+
+def _zipRoot(zip_path):
+    """
+    Name of the .SAFE directory at the root of a zipped product
+    """
+    members = _zipMembers(zip_path, os.path.getmtime(zip_path))
+    return members[0].split('/')[0]
+
+
+def globProduct(prod, pattern, relative=False):
+    """
+    Glob files and directories within a product, extracted or zipped
+
+    :param prod: path to the .SAFE directory or the .zip
+    :param pattern: glob pattern relative to the root of the .SAFE directory, with / as separator,
+        e.g. 'GRANULE/L*/IMG_DATA/*B01*'. As with glob, * does not match across /
+    :param relative: return the paths relative to the root of the .SAFE directory, with / as separator
+    :return: list of paths, /vsizip/ paths for a zipped product
+    """
+    if not isZipProduct(prod):
+        matches = glob(os.path.join(prod, *pattern.split('/')))
+        if relative:
+            matches = [os.path.relpath(match, prod).replace(os.sep, '/') for match in matches]
+        return matches
+
+    zip_path = os.path.abspath(prod)
+    root = _zipRoot(zip_path)
+    parts = pattern.split('/')
+
+    # Directories are not always stored in the zip, they are taken from the paths of the files
+    names = []
+    seen = set()
+    for member in _zipMembers(zip_path, os.path.getmtime(zip_path)):
+        member = member.rstrip('/').split('/')[1:]
+        for end in range(1, len(member) + 1):
+            name = '/'.join(member[:end])
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    matches = [name for name in names if len(name.split('/')) == len(parts)
+               and all(fnmatchcase(n, p) for n, p in zip(name.split('/'), parts))]
+    if relative:
+        return matches
+    return [VSIZIP + zip_path + '/' + root + '/' + name for name in matches]
+
+
+def openProductFile(prod, relpath):
+    """
+    Open a file of a product for reading in binary mode, e.g. manifest.safe to parse with lxml
+
+    :param prod: path to the .SAFE directory or the .zip
+    :param relpath: path relative to the root of the .SAFE directory, with / as separator
+    :return: file object
+    """
+    relpath = posixpath.normpath(relpath.replace('\\', '/'))
+    if not isZipProduct(prod):
+        return open(os.path.join(prod, *relpath.split('/')), 'rb')
+
+    zip_path = os.path.abspath(prod)
+    zf = zipfile.ZipFile(zip_path)
+    try:
+        member = zf.open(_zipRoot(zip_path) + '/' + relpath)
+    except Exception:
+        zf.close()
+        raise
+    # The member keeps its own handle to the zip, closing the ZipFile here only drops ours
+    zf.close()
+    return member
+
+
+def _metadataPath(prod):
+    """
+    Path of the product metadata (MTD_MSIL1C.xml or MTD_MSIL2A.xml) relative to the root of the .SAFE directory, from
+    the data objects of manifest.safe
+    """
+    with openProductFile(prod, 'manifest.safe') as manifest:
+        for event, element in iterparse(manifest, events=('end',), tag='dataObject'):
+            if element.attrib.get('ID', '').endswith('_Product_Metadata'):
+                return next(element.iter('fileLocation')).attrib['href']
+            element.clear()
+    raise ValueError("No product metadata listed in the manifest of {}".format(prod))
+
+
+def readMetadata(prod):
+    """
+    Read the footprint, sensing time, tile and band files of a product. The product metadata is parsed incrementally
+    and parsing stops at the first footprint, which follows the general information in the file
+
+    :param prod: path to the .SAFE directory or the .zip
+    :return: dict with 'footprint' (the EXT_POS_LIST as a list of alternating latitude and longitude), 'sensing_time'
+        (PRODUCT_START_TIME), 'tile_id' (e.g. 'T33XVJ') and 'bands' (paths of the band files relative to the root of
+        the .SAFE directory)
+    """
+    metadata = {'footprint': None, 'sensing_time': None, 'tile_id': None, 'bands': []}
+    with openProductFile(prod, _metadataPath(prod)) as src:
+        for event, element in iterparse(src, events=('end',),
+                                        tag=('PRODUCT_START_TIME', 'IMAGE_FILE', 'EXT_POS_LIST')):
+            if element.tag == 'PRODUCT_START_TIME':
+                metadata['sensing_time'] = element.text.strip()
+            elif element.tag == 'IMAGE_FILE':
+                metadata['bands'].append(element.text.strip() + '.jp2')
+            else:
+                metadata['footprint'] = [float(coord) for coord in element.text.split()]
+                break
+            element.clear()
+
+    if metadata['footprint'] is None:
+        raise ValueError("No footprint in the metadata of {}".format(prod))
+    tile = re.search(r'_(T\d{2}[A-Z]{3})_', productName(prod) + '_')
+    if tile is None and metadata['bands']:
+        tile = re.search(r'_(T\d{2}[A-Z]{3})_', metadata['bands'][0])
+    metadata['tile_id'] = tile.group(1) if tile is not None else None
+    return metadata
+
+
+def _productStat(prod):
+    """
+    Size and modification time identifying the version of a product, of the zip or of the manifest of a .SAFE
+    directory
+    """
+    stat = os.stat(prod if isZipProduct(prod) else os.path.join(prod, 'manifest.safe'))
+    return [stat.st_size, stat.st_mtime]
+
+
+def indexProducts(S2Dir, pattern='*', cache_path=None):
+    """
+    Metadata of the products in a directory, see readMetadata. The metadata is cached in a JSON file and only read
+    again for new or changed products, so a directory of thousands of products is parsed once
+
+    :param S2Dir: directory with the products, extracted or zipped
+    :param pattern: glob pattern of the product names, e.g. '*MSIL1C*'
+    :param cache_path: path to the cache, default S2_metadata.json in S2Dir. The index still works, without caching,
+        when the cache can not be written, and a cache that can not be read is rebuilt
+    :return: dict of product path: metadata
+    """
+    if cache_path is None:
+        cache_path = os.path.join(S2Dir, metadata_cache_name)
+    cache = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path) as src:
+                cache = json.load(src).get('products', {})
+        except (OSError, ValueError, AttributeError) as e:
+            print("Could not read the metadata cache {}, it is rebuilt, {}".format(cache_path, e))
+            cache = {}
+
+    index = {}
+    changed = False
+    for prod in listProducts(S2Dir, pattern):
+        name = productName(prod)
+        stat = _productStat(prod)
+        record = cache.get(name)
+        if record is None or record['path'] != os.path.basename(prod) or record['stat'] != stat:
+            record = {'path': os.path.basename(prod), 'stat': stat, 'metadata': readMetadata(prod)}
+            cache[name] = record
+            changed = True
+        index[prod] = record['metadata']
+
+    if changed:
+        # Each writer writes its own temporary file, the last one replacing the cache wins
+        try:
+            fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(cache_path)))
+            try:
+                with os.fdopen(fd, 'w') as dst:
+                    json.dump({'version': 1, 'products': cache}, dst, indent=1)
+                os.replace(tmp_file, cache_path)
+            except Exception:
+                os.remove(tmp_file)
+                raise
+        except OSError as e:
+            print("Could not write the metadata cache {}, {}".format(cache_path, e))
+    return index
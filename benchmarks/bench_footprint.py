@@ -0,0 +1,81 @@
+"""
+Benchmark of the footprint modes of Mask_S2_Overlap.createFootprint on synthetic polar stereographic masks.
+
+Reports wall time and peak memory allocated through numpy (traced with tracemalloc) for each raster size and mode.
+Example usage:
+
+    python benchmarks/bench_footprint.py --sizes 1000 2000 4000 --modes full edges outline
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Mask_S2_Overlap import createFootprint
+
+
+def create_mask(path, size):
+    """
+    Write a square uint8 mask in EPSG:3413 (500 m pixels) with a diagonal nodata swath edge
+
+    :param path: path of the GeoTIFF to write
+    :param size: width and height of the raster in pixels
+    :return: path
+    """
+    profile = {
+        'driver': 'GTiff',
+        'height': size,
+        'width': size,
+        'count': 1,
+        'dtype': 'uint8',
+        'crs': 'EPSG:3413',
+        'transform': from_origin(-500000, -500000, 500, 500),
+        'nodata': 0,
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        for ij, window in dst.block_windows(1):
+            rows, cols = np.mgrid[window.row_off:window.row_off + window.height,
+                                  window.col_off:window.col_off + window.width]
+            block = ((rows + cols) % 5 + 1).astype('uint8')
+            block[cols < rows * 0.3] = 0
+            dst.write(block, 1, window=window)
+    return path
+
+
+def run(path, mode, step):
+    tracemalloc.start()
+    start = time.perf_counter()
+    lonlat, geom = createFootprint(path, saveasGeojson=False, mode=mode, step=step)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n_vertices = len(geom["features"][0]["geometry"]["coordinates"][0])
+    return elapsed, peak, n_vertices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs='+', type=int, default=[1000, 2000, 4000],
+                        help="Width and height of the synthetic masks in pixels, default=1000 2000 4000")
+    parser.add_argument("--modes", nargs='+', default=['full', 'edges', 'outline'],
+                        help="Footprint modes to benchmark, default=full edges outline")
+    parser.add_argument("--step", type=int, default=100, help="Footprint step in pixels, default=100")
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>10} {:>14} {:>9}".format('size', 'mode', 'time [s]', 'peak mem [MB]', 'vertices'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = create_mask(os.path.join(tmp, 'mask_{}.tif'.format(size)), size)
+            for mode in args.modes:
+                elapsed, peak, n_vertices = run(path, mode, args.step)
+                print("{:>8} {:>8} {:>10.3f} {:>14.1f} {:>9}".format(size, mode, elapsed, peak / 1e6, n_vertices))
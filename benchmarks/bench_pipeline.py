@@ -0,0 +1,100 @@
+"""
+Benchmark of the pipeline on synthetic data: footprint of the mask and search of the overlapping S2 products
+(Mask_S2_Overlap.findS2Products), reprojection of the products onto the mask (ReprojectS2Products), merge of the
+reprojected products (MergeRasters) and reprojection of ACOLITE outputs (Acolite_reproject_stack_bands).
+
+The masks, the .SAFE products and the ACOLITE outputs are generated by synthetic.py, and the hub is replaced by a stub
+of SentinelAPI, so the benchmark runs offline. The time, peak memory and I/O of each stage are recorded with
+Instrumentation and can be written to a file with --profile_out. The peak memory is only measured on Linux. Example
+usage:
+
+    python benchmarks/bench_pipeline.py --sizes 1000 4000 --band_sizes 1098 5490 --products 2 4
+"""
+import argparse
+import contextlib
+import itertools
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Instrumentation
+from Mask_S2_Overlap import findS2Products
+from Reproject_acolite import Acolite_reproject_stack_bands
+from S2_Reproject_Merge import MergeRasters, ReprojectS2Products
+from synthetic import StubSentinelAPI, create_acolite_outputs, create_safe_products, create_synthetic_mask
+
+stages = ['createFootprint', 'searchSITPixels', 'ReprojectS2Products', 'MergeRasters',
+          'Acolite_reproject_stack_bands']
+
+
+def run(tmp, size, band_size, n_products, driver='JP2OpenJPEG', workers=1):
+    """
+    Generate the synthetic data of one case and run the pipeline on it
+
+    :param tmp: directory of the data, emptied by the caller
+    :param size: width and height of the mask in pixels
+    :param band_size: width and height of the 10 m bands in pixels, the ACOLITE outputs are 6 times smaller (60 m)
+    :param n_products: number of S2 products and of ACOLITE outputs
+    :param driver: driver of the S2 bands, 'JP2OpenJPEG' or 'GTiff'
+    :param workers: number of band groups reprojected at the same time
+    :return: records of the stages of the case, and the number of products kept by the search
+    """
+    mask = create_synthetic_mask(tmp, size)
+    products_dir = os.path.join(tmp, 'S2')
+    os.makedirs(products_dir)
+    products = create_safe_products(products_dir, mask, count=n_products, band_size=band_size, driver=driver)
+    acolite_dir = os.path.join(tmp, 'acolite')
+    os.makedirs(acolite_dir)
+    acolite_outputs = create_acolite_outputs(acolite_dir, mask, count=n_products, size=max(1, band_size // 6))
+    api = StubSentinelAPI(products)
+
+    first = len(Instrumentation.records())
+    # The functions print a line per product
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        kept = findS2Products(mask, api, validinterval=(1, 5), minS2pixels=0, minS2pixelPerc=0)
+        ReprojectS2Products(mask, products_dir, os.path.join(tmp, 'reprojected'), 'L1C', workers=workers)
+        MergeRasters(os.path.join(tmp, 'reprojected'), os.path.join(tmp, 'merged'), referencePath=mask)
+        Acolite_reproject_stack_bands(mask, acolite_outputs, os.path.join(tmp, 'acolite_stacked.tif'))
+    return Instrumentation.records()[first:], len(kept)
+
+
+def _megabytes(value):
+    return float('nan') if value is None else value / 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs='+', type=int, default=[1000, 2000, 4000],
+                        help="Width and height of the synthetic masks in pixels, default=1000 2000 4000")
+    parser.add_argument("--band_sizes", nargs='+', type=int, default=[1098],
+                        help="Width and height of the 10 m bands of the S2 products in pixels (10980 for full "
+                             "products), default=1098")
+    parser.add_argument("--products", nargs='+', type=int, default=[4],
+                        help="Number of S2 products and ACOLITE outputs, default=4")
+    parser.add_argument("--driver", default='JP2OpenJPEG', choices=['JP2OpenJPEG', 'GTiff'],
+                        help="Format of the S2 bands, default=JP2OpenJPEG")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Band groups reprojected at the same time, default=1")
+    parser.add_argument("--profile_out", default=None,
+                        help="Write the records of all stages to this .json or .csv file, default=None")
+    args = parser.parse_args()
+
+    Instrumentation.enable()
+    print("{:>6} {:>6} {:>5} {:>30} {:>9} {:>13} {:>10} {:>11}".format(
+        'size', 'band', 'prods', 'stage', 'time [s]', 'peak RSS [MB]', 'read [MB]', 'write [MB]'))
+    for size, band_size, n_products in itertools.product(args.sizes, args.band_sizes, args.products):
+        with tempfile.TemporaryDirectory() as tmp:
+            with Instrumentation.stage('case', size=size, band_size=band_size, products=n_products):
+                records, n_kept = run(tmp, size, band_size, n_products, args.driver, args.workers)
+        for name in stages:
+            for record in records:
+                if record['stage'] == name:
+                    print("{:>6} {:>6} {:>5} {:>30} {:>9.3f} {:>13.1f} {:>10.1f} {:>11.1f}".format(
+                        size, band_size, n_products, name, record['wall_time'], _megabytes(record['peak_rss']),
+                        _megabytes(record['read_chars']), _megabytes(record['write_chars'])))
+        if n_kept < n_products:
+            print("Only {} of {} products kept by the search".format(n_kept, n_products))
+
+    if args.profile_out is not None:
+        Instrumentation.exportRecords(args.profile_out)
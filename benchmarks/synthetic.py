@@ -0,0 +1,212 @@
+"""
+Synthetic inputs for the benchmarks: polar stereographic masks, Sentinel-2 level 1C products in .SAFE format with
+manifest.safe, product metadata and JPEG2000 or GeoTIFF bands, ACOLITE rhos_* outputs, and a stub of SentinelAPI
+answering queries from the synthetic products, so the whole pipeline runs offline.
+
+The products are placed on a grid around the centre of the mask, overlapping like neighbouring S2 tiles, in the UTM
+zone of the centre. Band sizes are given for the 10 m bands, the 20 m and 60 m bands are 2 and 6 times smaller.
+"""
+import os
+import sys
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import rasterio
+import shapely.geometry
+import shapely.wkt
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from CRS_transform import getTransformer
+from bench_footprint import create_mask
+
+band_resolutions = {'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20, 'B06': 20, 'B07': 20, 'B08': 10,
+                    'B8A': 20, 'B09': 60, 'B10': 60, 'B11': 20, 'B12': 20}
+acolite_bands = ['443', '492', '560', '665', '704', '740', '783', '833', '865', '1614', '2202']
+mask_time = datetime(2019, 3, 11, 10, 35, 37)
+sensing_time = datetime(2019, 3, 11, 10, 50, 1)
+
+
+def create_synthetic_mask(directory, size):
+    """
+    Write a mask of size x size 500 m pixels in EPSG:3413, named with its sensing time like the SLSTR masks
+
+    :param directory: directory of the mask
+    :param size: width and height of the mask in pixels
+    :return: path to the mask
+    """
+    name = '{}_103837_synthetic_mask_{}.tif'.format(mask_time.strftime('%Y%m%d_%H%M%S'), size)
+    return create_mask(os.path.join(directory, name), size)
+
+
+def _utmCRS(mask_path):
+    """
+    UTM CRS and coordinates of the centre of a mask
+    """
+    with rasterio.open(mask_path) as mask:
+        left, bottom, right, top = mask.bounds
+        crs = mask.crs
+    lon, lat = getTransformer(crs, 'EPSG:4326').transform((left + right) / 2, (bottom + top) / 2)
+    utm = 'EPSG:{}'.format((32600 if lat >= 0 else 32700) + int((lon + 180) // 6) % 60 + 1)
+    x, y = getTransformer('EPSG:4326', utm).transform(lon, lat)
+    return utm, x, y
+
+
+def _tileFootprint(crs, left, top, size_m):
+    """
+    Footprint of a tile in longitude/latitude
+    """
+    xs = [left, left + size_m, left + size_m, left, left]
+    ys = [top, top, top - size_m, top - size_m, top]
+    lons, lats = getTransformer(crs, 'EPSG:4326').transform(xs, ys)
+    return shapely.geometry.Polygon(zip(lons, lats))
+
+
+def _write_metadata(safe, name, footprint, image_files):
+    """
+    Write manifest.safe and MTD_MSIL1C.xml of a product
+    """
+    with open(os.path.join(safe, 'manifest.safe'), 'w') as dst:
+        dst.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1"><informationPackageMap/><metadataSection/>\n'
+                  '<dataObjectSection>\n'
+                  '<dataObject ID="S2_Level-1C_Product_Metadata"><byteStream mimeType="text/xml">'
+                  '<fileLocation locatorType="URL" href="./MTD_MSIL1C.xml"/></byteStream></dataObject>\n'
+                  '</dataObjectSection></xfdu:XFDU>\n')
+    positions = ' '.join('{:.6f} {:.6f}'.format(lat, lon) for lon, lat in footprint.exterior.coords)
+    files = ''.join('<IMAGE_FILE>{}</IMAGE_FILE>'.format(image_file) for image_file in image_files)
+    with open(os.path.join(safe, 'MTD_MSIL1C.xml'), 'w') as dst:
+        dst.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/'
+                  'User_Product_Level-1C.xsd">\n'
+                  '<n1:General_Info><Product_Info><PRODUCT_START_TIME>{}</PRODUCT_START_TIME>'
+                  '<PRODUCT_URI>{}.SAFE</PRODUCT_URI><Product_Organisation><Granule_List><Granule>{}</Granule>'
+                  '</Granule_List></Product_Organisation></Product_Info></n1:General_Info>\n'
+                  '<n1:Geometric_Info><Product_Footprint><Product_Footprint><Global_Footprint>'
+                  '<EXT_POS_LIST>{}</EXT_POS_LIST></Global_Footprint></Product_Footprint></Product_Footprint>'
+                  '</n1:Geometric_Info>\n'
+                  '</n1:Level-1C_User_Product>\n'.format(sensing_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'), name,
+                                                         files, positions))
+
+
+def create_safe_products(directory, mask_path, count=4, band_size=1098, bands=None, driver='JP2OpenJPEG',
+                         tile_size_m=109800, seed=0):
+    """
+    Write synthetic S2 level 1C products overlapping the centre of a mask
+
+    :param directory: directory of the products
+    :param mask_path: path to the mask, see create_synthetic_mask
+    :param count: number of products
+    :param band_size: width and height of the 10 m bands in pixels, the pixel size is tile_size_m / band_size
+    :param bands: band names, default all 13 bands
+    :param driver: 'JP2OpenJPEG' (lossless JPEG2000, .jp2) or 'GTiff' (.tif)
+    :param tile_size_m: width and height of a tile in metres
+    :param seed: seed of the random band values
+    :return: list of paths to the .SAFE directories, and the footprint of each product in longitude/latitude
+    """
+    bands = list(band_resolutions) if bands is None else bands
+    crs, x0, y0 = _utmCRS(mask_path)
+    rng = np.random.RandomState(seed)
+    extension = 'jp2' if driver == 'JP2OpenJPEG' else 'tif'
+    options = {'QUALITY': 100, 'REVERSIBLE': 'YES'} if driver == 'JP2OpenJPEG' else {}
+    columns = int(np.ceil(np.sqrt(count)))
+
+    products = []
+    for k in range(count):
+        # Neighbouring tiles overlap by 10 %, like the S2 tiling grid
+        left = x0 + (k % columns - columns / 2) * 0.9 * tile_size_m
+        top = y0 + (columns / 2 - k // columns) * 0.9 * tile_size_m
+        tile = 'T{:02d}X{}{}'.format(int(crs[-2:]), chr(ord('A') + k // 26 % 26), chr(ord('A') + k % 26))
+        stamp = sensing_time.strftime('%Y%m%dT%H%M%S')
+        name = 'S2A_MSIL1C_{}_N0207_R037_{}_{}'.format(stamp, tile, stamp)
+        safe = os.path.join(directory, name + '.SAFE')
+        granule = 'GRANULE/L1C_{}_A000000_{}/IMG_DATA'.format(tile, stamp)
+        image_dir = os.path.join(safe, *granule.split('/'))
+        os.makedirs(image_dir)
+
+        image_files = []
+        for band in bands:
+            factor = band_resolutions[band] // 10
+            size = max(1, band_size // factor)
+            data = rng.randint(1, 10000, size=(size, size), dtype='uint16')
+            # Nodata border on the west side, as on the edges of the swath
+            data[:, :size // 10] = 0
+            profile = dict(driver=driver, width=size, height=size, count=1, dtype='uint16', crs=crs,
+                           transform=from_origin(left, top, tile_size_m / size, tile_size_m / size), **options)
+            image_file = '{}/{}_{}_{}'.format(granule, tile, stamp, band)
+            # Like the real bands, the georeferencing is in the file and no .aux.xml is written next to it
+            with rasterio.Env(GDAL_PAM_ENABLED='NO'):
+                with rasterio.open(os.path.join(safe, *image_file.split('/')) + '.' + extension, 'w',
+                                   **profile) as dst:
+                    dst.write(data, 1)
+            image_files.append(image_file)
+
+        footprint = _tileFootprint(crs, left, top, tile_size_m)
+        _write_metadata(safe, name, footprint, image_files)
+        products.append((safe, footprint))
+    return products
+
+
+def create_acolite_outputs(directory, mask_path, count=2, size=1830, tile_size_m=109800, seed=0):
+    """
+    Write synthetic ACOLITE outputs, one folder of float32 rhos_* bands (NaN as nodata) per output, overlapping the
+    centre of a mask
+
+    :param directory: directory the output folders are created in
+    :param mask_path: path to the mask, see create_synthetic_mask
+    :param count: number of ACOLITE outputs
+    :param size: width and height of the bands in pixels (1830 for 60 m over a tile)
+    :param tile_size_m: width and height of an output in metres
+    :param seed: seed of the random band values
+    :return: list of paths to the output folders
+    """
+    crs, x0, y0 = _utmCRS(mask_path)
+    rng = np.random.RandomState(seed)
+    outputs = []
+    for k in range(count):
+        output = os.path.join(directory, 'acolite_{}'.format(k))
+        os.makedirs(output)
+        left = x0 + (k - count / 2) * 0.9 * tile_size_m
+        profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='float32', crs=crs,
+                       nodata=float('nan'), transform=from_origin(left, y0, tile_size_m / size, tile_size_m / size))
+        for band in acolite_bands:
+            data = rng.random_sample((size, size)).astype('float32') * 0.3
+            data[:, :size // 10] = np.nan
+            name = 'S2A_MSI_{}_L2R_rhos_{}.tif'.format(sensing_time.strftime('%Y_%m_%d_%H_%M_%S'), band)
+            with rasterio.open(os.path.join(output, name), 'w', **profile) as dst:
+                dst.write(data, 1)
+        outputs.append(output)
+    return outputs
+
+
+class StubSentinelAPI(object):
+    """
+    Stand-in for sentinelsat.SentinelAPI answering queries from a list of synthetic products, with the query and
+    get_product_odata methods used by Mask_S2_Overlap and S2_download
+    """
+
+    def __init__(self, products):
+        """
+        :param products: list of (path to the .SAFE directory, footprint in longitude/latitude), see
+            create_safe_products
+        """
+        self.products = OrderedDict()
+        for safe, footprint in products:
+            title = os.path.basename(safe)[:-len('.SAFE')]
+            self.products[title] = {'uuid': title, 'identifier': title, 'title': title, 'footprint': footprint.wkt,
+                                    'beginposition': sensing_time, 'cloudcoverpercentage': 0.0}
+        self.session = None
+
+    def query(self, area=None, date=None, **keywords):
+        area = shapely.wkt.loads(area) if area is not None else None
+        found = OrderedDict()
+        for uuid, product in self.products.items():
+            if date is not None and not date[0] <= product['beginposition'] <= date[1]:
+                continue
+            if area is None or shapely.wkt.loads(product['footprint']).intersects(area):
+                found[uuid] = dict(product)
+        return found
+
+    def get_product_odata(self, uuid):
+        return {'id': uuid, 'title': self.products[uuid]['title'], 'url': None, 'md5': None, 'Online': True}